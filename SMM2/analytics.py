@@ -0,0 +1,189 @@
+import json
+import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from . import encryption
+from .level import COURSE, LEVEL_SIZE, CLEAR_CONDITIONS, HEADER_ENUMS, MAP_ENUMS, OBJECT_NAMES
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# Statistics over many courses at once. The decrypted courses are written one after another into a
+# single file that is memory mapped as a numpy array of level.COURSE records, queries read whole
+# columns of it instead of parsing every course.
+#
+# python -m SMM2.analytics build corpus.bin <.bcd files, level store objects or directories>
+# python -m SMM2.analytics stats corpus.bin
+
+CHUNK_SIZE = 1024
+AREAS = ["overworld", "subworld"]
+
+def find_sources(paths):
+	# .bcd files are encrypted, .zst and .zz files are the decrypted objects of a level store
+	sources = []
+	for path in paths:
+		if os.path.isdir(path):
+			for directory, directories, files in os.walk(path):
+				directories.sort()
+				sources += [os.path.join(directory, name) for name in sorted(files) if name.endswith((".bcd", ".zst", ".zz"))]
+		else:
+			sources.append(path)
+	return sources
+
+def read_course(path, output):
+	with open(path, "rb") as f:
+		data = f.read()
+	if path.endswith(".bcd"):
+		encryption.decrypt_bcd_buffer(data, memoryview(output))
+		return
+	if path.endswith(".zst"):
+		if zstandard is None:
+			raise RuntimeError("%s is compressed with zstd but zstandard is not installed" % path)
+		data = zstandard.ZstdDecompressor().decompress(data)
+	else:
+		data = zlib.decompress(data)
+	if len(data) != LEVEL_SIZE:
+		raise ValueError("Course data is 0x%X bytes, expected 0x%X" % (len(data), LEVEL_SIZE))
+	output[:] = numpy.frombuffer(data, numpy.uint8)
+
+def build_chunk(corpus_path, total, start, paths):
+	# Runs in a worker process, every course is decrypted straight into its place in the file
+	raw = numpy.memmap(corpus_path, dtype=numpy.uint8, mode="r+", shape=(total, LEVEL_SIZE))
+	valid = []
+	for index, path in enumerate(paths, start):
+		try:
+			read_course(path, raw[index])
+			valid.append(True)
+		except Exception as e:
+			print("Skipping %s: %s" % (path, e))
+			raw[index] = 0
+			valid.append(False)
+	raw.flush()
+	return start, valid
+
+def build_corpus(corpus_path, sources, processes = None, chunk_size = 256):
+	total = len(sources)
+	# Sized up front so the workers can all write into it
+	with open(corpus_path, "wb") as f:
+		f.truncate(total * LEVEL_SIZE)
+
+	valid = [False] * total
+	with ProcessPoolExecutor(processes) as executor:
+		futures = [executor.submit(build_chunk, corpus_path, total, start, sources[start:start + chunk_size])
+			for start in range(0, total, chunk_size)]
+		for future in futures:
+			start, chunk_valid = future.result()
+			valid[start:start + len(chunk_valid)] = chunk_valid
+
+	with open(corpus_path + ".json", "w") as f:
+		json.dump({"sources": sources, "valid": valid}, f)
+	return Corpus(corpus_path)
+
+class Corpus:
+	def __init__(self, path):
+		with open(path + ".json") as f:
+			index = json.load(f)
+		self.sources = index["sources"]
+		self.valid = numpy.array(index["valid"], dtype=bool)
+		if len(self.sources) == 0:
+			self.courses = numpy.zeros(0, dtype=COURSE)
+		else:
+			self.courses = numpy.memmap(path, dtype=COURSE, mode="r", shape=(len(self.sources),))
+
+	def __len__(self):
+		return int(self.valid.sum())
+
+	def chunks(self):
+		# Slices of the memory map with the mask of courses that could be read, only the
+		# columns a query uses are ever loaded
+		for start in range(0, len(self.courses), CHUNK_SIZE):
+			yield self.courses[start:start + CHUNK_SIZE], self.valid[start:start + CHUNK_SIZE]
+
+	def object_usage_by_style(self):
+		# Number of objects of every type, per game style
+		styles = sorted(HEADER_ENUMS["gamestyle"])
+		counts = numpy.zeros((len(styles), len(OBJECT_NAMES)), dtype=numpy.int64)
+		for chunk, valid in self.chunks():
+			style = numpy.searchsorted(styles, chunk["header"]["gamestyle"])
+			known = valid & numpy.isin(chunk["header"]["gamestyle"], styles)
+			for area in AREAS:
+				objects = chunk[area]["objects"]
+				used = numpy.arange(objects.shape[1]) < chunk[area]["header"]["object_count"][:, None]
+				ids = objects["id"]
+				used &= known[:, None] & (ids >= 0) & (ids < len(OBJECT_NAMES))
+				keys = numpy.broadcast_to(style[:, None], ids.shape)[used] * len(OBJECT_NAMES) + ids[used]
+				counts += numpy.bincount(keys, minlength=counts.size).reshape(counts.shape)
+
+		return {HEADER_ENUMS["gamestyle"][style]: {OBJECT_NAMES[id]: int(counts[i, id]) for id in numpy.nonzero(counts[i])[0]}
+			for i, style in enumerate(styles)}
+
+	def ground_density(self):
+		# Ground tiles per tile of area, boundaries are in 16 pixel tiles
+		densities = {area: [] for area in AREAS}
+		for chunk, valid in self.chunks():
+			for area in AREAS:
+				header = chunk[area]["header"]
+				width = (header["boundary_right"].astype(numpy.int64) - header["boundary_left"]) // 16
+				height = (header["boundary_top"].astype(numpy.int64) - header["boundary_bottom"]) // 16
+				size = width * height
+				has_size = valid & (size > 0)
+				densities[area].append(header["ground_count"][has_size] / size[has_size])
+
+		summary = {}
+		for area in AREAS:
+			values = numpy.concatenate(densities[area]) if len(densities[area]) != 0 else numpy.zeros(0)
+			if len(values) == 0:
+				summary[area] = {"courses": 0}
+				continue
+			percentiles = numpy.percentile(values, [10, 50, 90])
+			summary[area] = {
+				"courses": len(values),
+				"mean": float(values.mean()),
+				"p10": float(percentiles[0]),
+				"median": float(percentiles[1]),
+				"p90": float(percentiles[2])
+			}
+		return summary
+
+	def clear_condition_distribution(self):
+		conditions = [chunk["header"]["clear_condition"][valid] for chunk, valid in self.chunks()]
+		if len(conditions) == 0:
+			return {}
+		values, counts = numpy.unique(numpy.concatenate(conditions), return_counts=True)
+		return {CLEAR_CONDITIONS.get(int(value), str(value)): int(count) for value, count in zip(values, counts)}
+
+	def theme_distribution(self):
+		themes = MAP_ENUMS["theme"]
+		counts = numpy.zeros(len(themes), dtype=numpy.int64)
+		for chunk, valid in self.chunks():
+			theme = chunk["overworld"]["header"]["theme"][valid]
+			counts += numpy.bincount(theme[theme < len(themes)], minlength=len(themes))
+		return {themes[i]: int(count) for i, count in enumerate(counts)}
+
+	def statistics(self):
+		return {
+			"courses": len(self),
+			"object_usage_by_style": self.object_usage_by_style(),
+			"ground_density": self.ground_density(),
+			"clear_conditions": self.clear_condition_distribution(),
+			"themes": self.theme_distribution()
+		}
+
+if __name__ == "__main__":
+	if len(sys.argv) >= 4 and sys.argv[1] == "build":
+		sources = find_sources(sys.argv[3:])
+		print("Decrypting %d courses" % len(sources))
+		corpus = build_corpus(sys.argv[2], sources)
+		print("%d of %d courses in %s" % (len(corpus), len(sources), sys.argv[2]))
+	elif len(sys.argv) == 3 and sys.argv[1] == "stats":
+		print(json.dumps(Corpus(sys.argv[2]).statistics(), indent="\t"))
+	else:
+		print("Usage: python -m SMM2.analytics build <corpus> <paths...>")
+		print("       python -m SMM2.analytics stats <corpus>")
+		sys.exit(1)
@@ -114,17 +114,28 @@ def decrypt_bcd(
 def encrypt_bcd(
     data: bytes,
     *args,
+    header: bytes = None,
+    iv: bytes = None,
+    seed: bytes = None,
     **kwargs
 ) -> bytes:
+    # Passing the header, iv and seed of a decrypted file gives back the exact original file
     stream: io.BytesIO = io.BytesIO(
         data
     )
 
-    header: io.BytesIO = io.BytesIO()
     decrypted: bytes = stream.read(
         0x5bfc0
     )
 
+    if header is not None:
+        return header + encrypt_bcd_body(
+            decrypted,
+            iv,
+            seed
+        )
+
+    header: io.BytesIO = io.BytesIO()
     header.write(
         struct.pack(
             '<I',
@@ -149,10 +160,27 @@ def encrypt_bcd(
         )
     )
 
-    seed: bytes = get_random_bytes(
-        0x10
+    return header.getvalue() + encrypt_bcd_body(
+        decrypted,
+        iv,
+        seed
     )
 
+
+def encrypt_bcd_body(
+    decrypted: bytes,
+    iv: bytes = None,
+    seed: bytes = None
+) -> bytes:
+    if seed is None:
+        seed: bytes = get_random_bytes(
+            0x10
+        )
+    if iv is None:
+        iv: bytes = get_random_bytes(
+            0x10
+        )
+
     context: tuple = struct.unpack_from(
         '<IIII',
         seed
@@ -169,9 +197,7 @@ def encrypt_bcd(
     aes: _mode_cbc.CbcMode = AES.new(
         key,
         AES.MODE_CBC,
-        get_random_bytes(
-            0x10
-        )
+        iv
     )
     encrypted: bytes = aes.encrypt(
         decrypted
@@ -190,7 +216,179 @@ def encrypt_bcd(
         decrypted
     )
 
-    return header.getvalue() + encrypted + aes.iv + seed + mac.digest()
+    return encrypted + iv + seed + mac.digest()
+
+
+def split_bcd(
+    data: bytes
+) -> tuple:
+    # The parts of an encrypted file that encrypt_bcd needs to rebuild it byte for byte
+    return (
+        data[:0x10],
+        data[0x10 + 0x5bfc0:0x10 + 0x5bfc0 + 0x10],
+        data[0x10 + 0x5bfc0 + 0x10:0x10 + 0x5bfc0 + 0x20]
+    )
+
+
+BCD_SIZE: int = 0x10 + 0x5bfc0 + 0x30
+BTL_SIZE: int = 0x1bfd0 + 0x30
+
+
+def decrypt_bcd_buffer(
+    data,
+    output=None
+) -> memoryview:
+    # Same as decrypt_bcd for anything with the buffer protocol (bytes, bytearray, memoryview, mmap).
+    # Decrypts into output, a writable buffer of 0x5bfc0 bytes, without copying the input
+    view: memoryview = memoryview(
+        data
+    )
+    if len(view) < BCD_SIZE:
+        raise ValueError(
+            'Course data is 0x%X bytes, expected 0x%X' % (len(view), BCD_SIZE)
+        )
+    if output is None:
+        output = bytearray(
+            0x5bfc0
+        )
+
+    footer: memoryview = view[0x10 + 0x5bfc0:BCD_SIZE]
+
+    random: Random = Random(
+        *struct.unpack_from(
+            '<IIII',
+            footer,
+            0x10
+        )
+    )
+
+    key: bytes = crypto.create_key(
+        random,
+        keytables.bcd,
+        0x10
+    )
+    aes: _mode_cbc.CbcMode = AES.new(
+        key,
+        AES.MODE_CBC,
+        bytes(
+            footer[:0x10]
+        )
+    )
+    aes.decrypt(
+        view[0x10:0x10 + 0x5bfc0],
+        output=output
+    )
+
+    key: bytes = crypto.create_key(
+        random,
+        keytables.bcd,
+        0x10
+    )
+    mac: CMAC.CMAC = CMAC.new(
+        key,
+        ciphermod=AES
+    )
+    mac.update(
+        output
+    )
+    mac.verify(
+        bytes(
+            footer[0x20:0x30]
+        )
+    )
+
+    return memoryview(
+        output
+    )
+
+
+def encrypt_bcd_buffer(
+    data,
+    output=None,
+    header=None,
+    iv: bytes = None,
+    seed: bytes = None
+) -> memoryview:
+    # Same as encrypt_bcd, writing the whole file into output, a writable buffer of BCD_SIZE bytes
+    decrypted: memoryview = memoryview(
+        data
+    )[:0x5bfc0]
+    if output is None:
+        output = bytearray(
+            BCD_SIZE
+        )
+    view: memoryview = memoryview(
+        output
+    )
+
+    if header is not None:
+        view[:0x10] = header
+    else:
+        struct.pack_into(
+            '<IHHI4s',
+            view,
+            0x0,
+            0x1,
+            0x10,
+            0x0,
+            zlib.crc32(
+                decrypted
+            ),
+            'SCDL'.encode(
+                'utf-8'
+            )
+        )
+
+    if seed is None:
+        seed: bytes = get_random_bytes(
+            0x10
+        )
+    if iv is None:
+        iv: bytes = get_random_bytes(
+            0x10
+        )
+
+    random: Random = Random(
+        *struct.unpack_from(
+            '<IIII',
+            seed
+        )
+    )
+
+    key: bytes = crypto.create_key(
+        random,
+        keytables.bcd,
+        0x10
+    )
+    aes: _mode_cbc.CbcMode = AES.new(
+        key,
+        AES.MODE_CBC,
+        iv
+    )
+    aes.encrypt(
+        decrypted,
+        output=view[0x10:0x10 + 0x5bfc0]
+    )
+
+    key: bytes = crypto.create_key(
+        random,
+        keytables.bcd,
+        0x10
+    )
+    mac: CMAC.CMAC = CMAC.new(
+        key,
+        ciphermod=AES
+    )
+    mac.update(
+        decrypted
+    )
+
+    footer: memoryview = view[0x10 + 0x5bfc0:BCD_SIZE]
+    footer[:0x10] = iv
+    footer[0x10:0x20] = seed
+    footer[0x20:0x30] = mac.digest()
+
+    return view
 
 
 def decrypt_btl(
@@ -318,6 +516,139 @@ def encrypt_btl(
     return encrypted + aes.iv + seed + mac.digest()
 
 
+def decrypt_btl_buffer(
+    data,
+    output=None
+) -> memoryview:
+    # Same as decrypt_btl for anything with the buffer protocol, decrypting into output
+    view: memoryview = memoryview(
+        data
+    )
+    if len(view) < BTL_SIZE:
+        raise ValueError(
+            'Course world data is 0x%X bytes, expected 0x%X' % (len(view), BTL_SIZE)
+        )
+    if output is None:
+        output = bytearray(
+            0x1bfd0
+        )
+
+    footer: memoryview = view[0x1bfd0:BTL_SIZE]
+
+    random: Random = Random(
+        *struct.unpack_from(
+            '<IIII',
+            footer,
+            0x10
+        )
+    )
+
+    key: bytes = crypto.create_key(
+        random,
+        keytables.btl,
+        0x10
+    )
+    aes: _mode_cbc.CbcMode = AES.new(
+        key,
+        AES.MODE_CBC,
+        bytes(
+            footer[:0x10]
+        )
+    )
+    aes.decrypt(
+        view[:0x1bfd0],
+        output=output
+    )
+
+    key: bytes = crypto.create_key(
+        random,
+        keytables.btl,
+        0x10
+    )
+    mac: CMAC.CMAC = CMAC.new(
+        key,
+        ciphermod=AES
+    )
+    mac.update(
+        output
+    )
+    mac.verify(
+        bytes(
+            footer[0x20:0x30]
+        )
+    )
+
+    return memoryview(
+        output
+    )
+
+
+def encrypt_btl_buffer(
+    data,
+    output=None
+) -> memoryview:
+    # Same as encrypt_btl, writing the whole file into output, a writable buffer of BTL_SIZE bytes
+    decrypted: memoryview = memoryview(
+        data
+    )[:0x1bfd0]
+    if output is None:
+        output = bytearray(
+            BTL_SIZE
+        )
+    view: memoryview = memoryview(
+        output
+    )
+
+    seed: bytes = get_random_bytes(
+        0x10
+    )
+    iv: bytes = get_random_bytes(
+        0x10
+    )
+
+    random: Random = Random(
+        *struct.unpack_from(
+            '<IIII',
+            seed
+        )
+    )
+
+    key: bytes = crypto.create_key(
+        random,
+        keytables.btl,
+        0x10
+    )
+    aes: _mode_cbc.CbcMode = AES.new(
+        key,
+        AES.MODE_CBC,
+        iv
+    )
+    aes.encrypt(
+        decrypted,
+        output=view[:0x1bfd0]
+    )
+
+    key: bytes = crypto.create_key(
+        random,
+        keytables.btl,
+        0x10
+    )
+    mac: CMAC.CMAC = CMAC.new(
+        key,
+        ciphermod=AES
+    )
+    mac.update(
+        decrypted
+    )
+
+    footer: memoryview = view[0x1bfd0:BTL_SIZE]
+    footer[:0x10] = iv
+    footer[0x10:0x20] = seed
+    footer[0x20:0x30] = mac.digest()
+
+    return view
+
+
 class Course(
     object
 ):
@@ -0,0 +1,297 @@
+import struct
+
+import numpy
+
+# Parser for the decrypted course format described in level.ksy.
+# Every table in a map has a fixed number of slots, they are read as numpy structured arrays
+# that view the course data directly and only cover the slots the map header counts as used
+
+HEADER_SIZE = 0x200
+MAP_SIZE = 0x2DEE0
+LEVEL_SIZE = HEADER_SIZE + MAP_SIZE * 2
+
+HEADER = struct.Struct("<BBhhhhbbbbBBIiiiiIqi189xhB66s202s")
+HEADER_FIELDS = ["start_y", "goal_y", "goal_x", "timer", "clear_condition_magnitude", "year", "month", "day", "hour", "minute",
+	"autoscroll_speed", "clear_condition_category", "clear_condition", "unk_gamever", "unk_management_flags", "clear_attempts",
+	"clear_time", "unk_creation_id", "unk_upload_id", "game_version", "gamestyle", "unk2", "name", "description"]
+
+MAP_HEADER = numpy.dtype([("theme", "u1"), ("autoscroll_type", "u1"), ("boundary_type", "u1"), ("orientation", "u1"),
+	("liquid_end_height", "u1"), ("liquid_mode", "u1"), ("liquid_speed", "u1"), ("liquid_start_height", "u1"),
+	("boundary_right", "<i4"), ("boundary_top", "<i4"), ("boundary_left", "<i4"), ("boundary_bottom", "<i4"), ("unk_flag", "<i4"),
+	("object_count", "<i4"), ("sound_effect_count", "<i4"), ("snake_block_count", "<i4"), ("clear_pipe_count", "<i4"),
+	("piranha_creeper_count", "<i4"), ("exclamation_mark_block_count", "<i4"), ("track_block_count", "<i4"), ("unk1", "<i4"),
+	("ground_count", "<i4"), ("track_count", "<i4"), ("ice_count", "<i4")])
+
+OBJECT = numpy.dtype([("x", "<i4"), ("y", "<i4"), ("unk1", "<i2"), ("width", "u1"), ("height", "u1"), ("flag", "<i4"),
+	("cflag", "<i4"), ("ex", "<i4"), ("id", "<i2"), ("cid", "<i2"), ("lid", "<i2"), ("sid", "<i2")])
+SOUND = numpy.dtype([("id", "u1"), ("x", "u1"), ("y", "u1"), ("unk1", "u1")])
+SNAKE_NODE = numpy.dtype([("index", "<u2"), ("direction", "<u2"), ("unk1", "<u4")])
+SNAKE = numpy.dtype([("index", "u1"), ("node_count", "u1"), ("unk1", "<u2"), ("nodes", SNAKE_NODE, (120,))])
+CLEAR_PIPE_NODE = numpy.dtype([("type", "u1"), ("index", "u1"), ("x", "u1"), ("y", "u1"), ("width", "u1"), ("height", "u1"),
+	("unk1", "u1"), ("direction", "u1")])
+CLEAR_PIPE = numpy.dtype([("index", "u1"), ("node_count", "u1"), ("unk", "<u2"), ("nodes", CLEAR_PIPE_NODE, (36,))])
+MOVING_NODE = numpy.dtype([("unk1", "u1"), ("direction", "u1"), ("unk2", "<u2")])
+PIRANHA_CREEPER = numpy.dtype([("unk1", "u1"), ("index", "u1"), ("node_count", "u1"), ("unk2", "u1"), ("nodes", MOVING_NODE, (20,))])
+EXCLAMATION_BLOCK = numpy.dtype([("unk1", "u1"), ("index", "u1"), ("node_count", "u1"), ("unk2", "u1"), ("nodes", MOVING_NODE, (10,))])
+TRACK_BLOCK = EXCLAMATION_BLOCK
+GROUND = numpy.dtype([("x", "u1"), ("y", "u1"), ("id", "u1"), ("background_id", "u1")])
+TRACK = numpy.dtype([("unk1", "<u2"), ("flags", "u1"), ("x", "u1"), ("y", "u1"), ("type", "u1"), ("lid", "<u2"), ("unk2", "<u2"),
+	("unk3", "<u2")])
+ICICLE = numpy.dtype([("x", "u1"), ("y", "u1"), ("type", "u1"), ("unk1", "u1")])
+
+# In file order, each table starts where the previous one ends: name, count field, slots, entry type
+TABLES = [
+	("objects", "object_count", 2600, OBJECT),
+	("sounds", "sound_effect_count", 300, SOUND),
+	("snakes", "snake_block_count", 5, SNAKE),
+	("clear_pipes", "clear_pipe_count", 200, CLEAR_PIPE),
+	("piranha_creepers", "piranha_creeper_count", 10, PIRANHA_CREEPER),
+	("exclamation_blocks", "exclamation_mark_block_count", 10, EXCLAMATION_BLOCK),
+	("track_blocks", "track_block_count", 10, TRACK_BLOCK),
+	("ground", "ground_count", 4000, GROUND),
+	("tracks", "track_count", 1500, TRACK),
+	("icicles", "ice_count", 300, ICICLE)
+]
+
+# The whole course as one record, for working on many courses at once
+COURSE_HEADER = numpy.dtype([("start_y", "u1"), ("goal_y", "u1"), ("goal_x", "<i2"), ("timer", "<i2"),
+	("clear_condition_magnitude", "<i2"), ("year", "<i2"), ("month", "i1"), ("day", "i1"), ("hour", "i1"), ("minute", "i1"),
+	("autoscroll_speed", "u1"), ("clear_condition_category", "u1"), ("clear_condition", "<u4"), ("unk_gamever", "<i4"),
+	("unk_management_flags", "<i4"), ("clear_attempts", "<i4"), ("clear_time", "<i4"), ("unk_creation_id", "<u4"),
+	("unk_upload_id", "<i8"), ("game_version", "<i4"), ("unk_padding", "V189"), ("gamestyle", "<i2"), ("unk2", "u1"),
+	("name", "V66"), ("description", "V202")])
+AREA = numpy.dtype([("header", MAP_HEADER)] + [(name, dtype, (slots,)) for name, count_field, slots, dtype in TABLES] +
+	[("unk2", "V%d" % 0xDBC)])
+COURSE = numpy.dtype([("header", COURSE_HEADER), ("overworld", AREA), ("subworld", AREA)])
+
+TABLE_OFFSETS = {}
+offset = MAP_HEADER.itemsize
+for name, count_field, slots, dtype in TABLES:
+	TABLE_OFFSETS[name] = offset
+	offset += slots * dtype.itemsize
+del offset
+
+def add_names(json_dict, names):
+	for field, values in names.items():
+		if field in json_dict and json_dict[field] in values:
+			json_dict[field + "_name"] = values[json_dict[field]]
+
+def decode_string(raw):
+	return raw.decode("utf-16-le", errors="replace").split("\0", 1)[0]
+
+def rows_json(rows):
+	# One dict per entry, nodes are cut down to the entry's node_count
+	if len(rows) == 0:
+		return []
+	fields = [field for field in rows.dtype.names if field != "nodes"]
+	entries = [dict(zip(fields, values)) for values in zip(*(rows[field].tolist() for field in fields))]
+	if "nodes" in rows.dtype.names:
+		for entry, nodes in zip(entries, rows["nodes"]):
+			entry["nodes"] = rows_json(nodes[:entry["node_count"]])
+	return entries
+
+class Area:
+	def __init__(self, data, offset):
+		self.data = data
+		self.offset = offset
+		self.header = numpy.frombuffer(data, MAP_HEADER, 1, offset)[0]
+		self.tables = {}
+
+	def __getattr__(self, name):
+		# Tables are only viewed when they are first used
+		if name not in TABLE_OFFSETS:
+			raise AttributeError(name)
+		return self.table(name)
+
+	def table(self, name):
+		if name not in self.tables:
+			for table_name, count_field, slots, dtype in TABLES:
+				if table_name == name:
+					count = min(max(int(self.header[count_field]), 0), slots)
+					self.tables[name] = numpy.frombuffer(self.data, dtype, count, self.offset + TABLE_OFFSETS[name])
+		return self.tables[name]
+
+	def settings(self):
+		area = {field: self.header[field].item() for field in MAP_HEADER.names}
+		add_names(area, MAP_ENUMS)
+		return area
+
+	def json(self):
+		area = self.settings()
+		for name, count_field, slots, dtype in TABLES:
+			area[name] = rows_json(self.table(name))
+		for obj in area["objects"]:
+			if 0 <= obj["id"] < len(OBJECT_NAMES):
+				obj["name"] = OBJECT_NAMES[obj["id"]]
+		return area
+
+class Level:
+	def __init__(self, data):
+		# data is the decrypted course, as returned by encryption.decrypt_bcd, in any buffer
+		if len(data) < LEVEL_SIZE:
+			raise ValueError("Course data is 0x%X bytes, expected 0x%X" % (len(data), LEVEL_SIZE))
+		self.data = data
+		self.areas = {}
+
+		self.header = dict(zip(HEADER_FIELDS, HEADER.unpack_from(data, 0)))
+		self.header["name"] = decode_string(self.header["name"])
+		self.header["description"] = decode_string(self.header["description"])
+		add_names(self.header, HEADER_ENUMS)
+
+	def area(self, index):
+		if index not in self.areas:
+			self.areas[index] = Area(self.data, HEADER_SIZE + MAP_SIZE * index)
+		return self.areas[index]
+
+	@property
+	def overworld(self):
+		return self.area(0)
+
+	@property
+	def subworld(self):
+		return self.area(1)
+
+	def json(self):
+		level = dict(self.header)
+		level["overworld"] = self.overworld.json()
+		level["subworld"] = self.subworld.json()
+		return level
+
+def parse_level(data):
+	return Level(data).json()
+
+# Enums from level.ksy
+
+CLEAR_CONDITIONS = {
+	0: "none",
+	137525990: "reach_the_goal_without_landing_after_leaving_the_ground",
+	199585683: "reach_the_goal_after_defeating_at_least_all_mechakoopa",
+	272349836: "reach_the_goal_after_defeating_at_least_all_cheep_cheep",
+	375673178: "reach_the_goal_without_taking_damage",
+	426197923: "reach_the_goal_as_boomerang_mario",
+	436833616: "reach_the_goal_while_wearing_a_shoe",
+	713979835: "reach_the_goal_as_fire_mario",
+	744927294: "reach_the_goal_as_frog_mario",
+	751004331: "reach_the_goal_after_defeating_at_least_all_larry",
+	900050759: "reach_the_goal_as_raccoon_mario",
+	947659466: "reach_the_goal_after_defeating_at_least_all_blooper",
+	976173462: "reach_the_goal_as_propeller_mario",
+	994686866: "reach_the_goal_while_wearing_a_propeller_box",
+	998904081: "reach_the_goal_after_defeating_at_least_all_spike",
+	1008094897: "reach_the_goal_after_defeating_at_least_all_boom_boom",
+	1051433633: "reach_the_goal_while_holding_a_koopa_shell",
+	1061233896: "reach_the_goal_after_defeating_at_least_all_porcupuffer",
+	1062253843: "reach_the_goal_after_defeating_at_least_all_charvaargh",
+	1079889509: "reach_the_goal_after_defeating_at_least_all_bullet_bill",
+	1080535886: "reach_the_goal_after_defeating_at_least_all_bully_bullies",
+	1151250770: "reach_the_goal_while_wearing_a_goomba_mask",
+	1182464856: "reach_the_goal_after_defeating_at_least_all_hop_chops",
+	1219761531: "reach_the_goal_while_holding_a_red_pow_block_or_reach_the_goal_after_activating_at_least_all_red_pow_block",
+	1221661152: "reach_the_goal_after_defeating_at_least_all_bob_omb",
+	1259427138: "reach_the_goal_after_defeating_at_least_all_spiny_spinies",
+	1268255615: "reach_the_goal_after_defeating_at_least_all_bowser_meowser",
+	1279580818: "reach_the_goal_after_defeating_at_least_all_ant_trooper",
+	1283945123: "reach_the_goal_on_a_lakitus_cloud",
+	1344044032: "reach_the_goal_after_defeating_at_least_all_boo",
+	1425973877: "reach_the_goal_after_defeating_at_least_all_roy",
+	1429902736: "reach_the_goal_while_holding_a_trampoline",
+	1431944825: "reach_the_goal_after_defeating_at_least_all_morton",
+	1446467058: "reach_the_goal_after_defeating_at_least_all_fish_bone",
+	1510495760: "reach_the_goal_after_defeating_at_least_all_monty_mole",
+	1656179347: "reach_the_goal_after_picking_up_at_least_all_1_up_mushroom",
+	1665820273: "reach_the_goal_after_defeating_at_least_all_hammer_bro",
+	1676924210: "reach_the_goal_after_hitting_at_least_all_p_switch_or_reach_the_goal_while_holding_a_p_switch",
+	1715960804: "reach_the_goal_after_activating_at_least_all_pow_block_or_reach_the_goal_while_holding_a_pow_block",
+	1724036958: "reach_the_goal_after_defeating_at_least_all_angry_sun",
+	1730095541: "reach_the_goal_after_defeating_at_least_all_pokey",
+	1780278293: "reach_the_goal_as_superball_mario",
+	1839897151: "reach_the_goal_after_defeating_at_least_all_pom_pom",
+	1969299694: "reach_the_goal_after_defeating_at_least_all_peepa",
+	2035052211: "reach_the_goal_after_defeating_at_least_all_lakitu",
+	2038503215: "reach_the_goal_after_defeating_at_least_all_lemmy",
+	2048033177: "reach_the_goal_after_defeating_at_least_all_lava_bubble",
+	2076496776: "reach_the_goal_while_wearing_a_bullet_bill_mask",
+	2089161429: "reach_the_goal_as_big_mario",
+	2111528319: "reach_the_goal_as_cat_mario",
+	2131209407: "reach_the_goal_after_defeating_at_least_all_goomba_galoomba",
+	2139645066: "reach_the_goal_after_defeating_at_least_all_thwomp",
+	2259346429: "reach_the_goal_after_defeating_at_least_all_iggy",
+	2549654281: "reach_the_goal_while_wearing_a_dry_bones_shell",
+	2694559007: "reach_the_goal_after_defeating_at_least_all_sledge_bro",
+	2746139466: "reach_the_goal_after_defeating_at_least_all_rocky_wrench",
+	2749601092: "reach_the_goal_after_grabbing_at_least_all_50_coin",
+	2855236681: "reach_the_goal_as_flying_squirrel_mario",
+	3036298571: "reach_the_goal_as_buzzy_mario",
+	3074433106: "reach_the_goal_as_builder_mario",
+	3146932243: "reach_the_goal_as_cape_mario",
+	3174413484: "reach_the_goal_after_defeating_at_least_all_wendy",
+	3206222275: "reach_the_goal_while_wearing_a_cannon_box",
+	3314955857: "reach_the_goal_as_link",
+	3342591980: "reach_the_goal_while_you_have_super_star_invincibility",
+	3346433512: "reach_the_goal_after_defeating_at_least_all_goombrat_goombud",
+	3348058176: "reach_the_goal_after_grabbing_at_least_all_10_coin",
+	3353006607: "reach_the_goal_after_defeating_at_least_all_buzzy_beetle",
+	3392229961: "reach_the_goal_after_defeating_at_least_all_bowser_jr",
+	3437308486: "reach_the_goal_after_defeating_at_least_all_koopa_troopa",
+	3459144213: "reach_the_goal_after_defeating_at_least_all_chain_chomp",
+	3466227835: "reach_the_goal_after_defeating_at_least_all_muncher",
+	3481362698: "reach_the_goal_after_defeating_at_least_all_wiggler",
+	3513732174: "reach_the_goal_as_smb2_mario",
+	3649647177: "reach_the_goal_in_a_koopa_clown_car_junior_clown_car",
+	3725246406: "reach_the_goal_as_spiny_mario",
+	3730243509: "reach_the_goal_in_a_koopa_troopa_car",
+	3748075486: "reach_the_goal_after_defeating_at_least_all_piranha_plant_jumping_piranha_plant",
+	3797704544: "reach_the_goal_after_defeating_at_least_all_dry_bones",
+	3824561269: "reach_the_goal_after_defeating_at_least_all_stingby_stingbies",
+	3833342952: "reach_the_goal_after_defeating_at_least_all_piranha_creeper",
+	3842179831: "reach_the_goal_after_defeating_at_least_all_fire_piranha_plant",
+	3874680510: "reach_the_goal_after_breaking_at_least_all_crates",
+	3974581191: "reach_the_goal_after_defeating_at_least_all_ludwig",
+	3977257962: "reach_the_goal_as_super_mario",
+	4042480826: "reach_the_goal_after_defeating_at_least_all_skipsqueak",
+	4116396131: "reach_the_goal_after_grabbing_at_least_all_coin",
+	4117878280: "reach_the_goal_after_defeating_at_least_all_magikoopa",
+	4122555074: "reach_the_goal_after_grabbing_at_least_all_30_coin",
+	4153835197: "reach_the_goal_as_balloon_mario",
+	4172105156: "reach_the_goal_while_wearing_a_red_pow_box",
+	4209535561: "reach_the_goal_while_riding_yoshi",
+	4269094462: "reach_the_goal_after_defeating_at_least_all_spike_top",
+	4293354249: "reach_the_goal_after_defeating_at_least_all_banzai_bill"
+}
+
+HEADER_ENUMS = {
+	"gamestyle": {12621: "smb1", 13133: "smb3", 22349: "smw", 21847: "nsmbw", 22323: "sm3dw"},
+	"clear_condition_category": {0: "none", 1: "parts", 2: "status", 3: "actions"},
+	"game_version": {0: "v1_0_0", 1: "v1_0_1", 2: "v1_1_0", 3: "v2_0_0", 4: "v3_0_0", 5: "v3_0_1", 33: "unk"},
+	"autoscroll_speed": {0: "x1", 1: "x2", 2: "x3"},
+	"clear_condition": CLEAR_CONDITIONS
+}
+
+MAP_ENUMS = {
+	"theme": {0: "overworld", 1: "underground", 2: "castle", 3: "airship", 4: "underwater", 5: "ghost_house", 6: "snow", 7: "desert", 8: "sky", 9: "forest"},
+	"autoscroll_type": {0: "none", 1: "slow", 2: "normal", 3: "fast", 4: "custom"},
+	"boundary_type": {0: "built_above_line", 1: "built_below_line"},
+	"orientation": {0: "horizontal", 1: "vertical"},
+	"liquid_mode": {0: "static", 1: "rising_or_falling", 2: "rising_and_falling"},
+	"liquid_speed": {0: "none", 1: "x1", 2: "x2", 3: "x3"}
+}
+
+OBJECT_NAMES = [
+	"goomba", "koopa", "piranha_flower", "hammer_bro", "block", "question_block", "hard_block", "ground", "coin",
+	"pipe", "spring", "lift", "thwomp", "bullet_bill_blaster", "mushroom_platform", "bob_omb",
+	"semisolid_platform", "bridge", "p_switch", "pow", "super_mushroom", "donut_block", "cloud", "note_block",
+	"fire_bar", "spiny", "goal_ground", "goal", "buzzy_beetle", "hidden_block", "lakitu", "lakitu_cloud",
+	"banzai_bill", "one_up", "fire_flower", "super_star", "lava_lift", "starting_brick", "starting_arrow",
+	"magikoopa", "spike_top", "boo", "clown_car", "spikes", "big_mushroom", "shoe_goomba", "dry_bones", "cannon",
+	"blooper", "castle_bridge", "jumping_machine", "skipsqueak", "wiggler", "fast_conveyor_belt", "burner",
+	"door", "cheep_cheep", "muncher", "rocky_wrench", "track", "lava_bubble", "chain_chomp", "bowser",
+	"ice_block", "vine", "stingby", "arrow", "one_way", "saw", "player", "big_coin", "half_collision_platform",
+	"koopa_car", "cinobio", "spike_ball", "stone", "twister", "boom_boom", "pokey", "p_block", "sprint_platform",
+	"smb2_mushroom", "donut", "skewer", "snake_block", "track_block", "charvaargh", "slight_slope",
+	"steep_slope", "reel_camera", "checkpoint_flag", "seesaw", "red_coin", "clear_pipe", "conveyor_belt", "key",
+	"ant_trooper", "warp_box", "bowser_jr", "on_off_block", "dotted_line_block", "water_marker", "monty_mole",
+	"fish_bone", "angry_sun", "swinging_claw", "tree", "piranha_creeper", "blinking_block", "sound_effect",
+	"spike_block", "mechakoopa", "crate", "mushroom_trampoline", "porkupuffer", "cinobic", "super_hammer",
+	"bully", "icicle", "exclamation_block", "lemmy", "morton", "larry", "wendy", "iggy", "roy", "ludwig",
+	"cannon_box", "propeller_box", "goomba_mask", "bullet_bill_mask", "red_pow_box", "on_off_trampoline"
+]
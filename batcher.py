@@ -0,0 +1,72 @@
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+	def __init__(self, fetch, window = 0.01, max_batch = 500):
+		# fetch receives a list of keys and returns the results in the same order
+		self.fetch = fetch
+		self.window = window
+		self.max_batch = max_batch
+		self.pending = {}
+		self.timer = None
+		self.tasks = set()
+
+		self.batches = 0
+		self.items = 0
+		self.largest_batch = 0
+
+	async def get(self, key):
+		future = self.pending.get(key)
+		if future is None:
+			future = asyncio.get_running_loop().create_future()
+			self.pending[key] = future
+			if len(self.pending) >= self.max_batch:
+				self.flush()
+			elif self.timer is None:
+				self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+		return await asyncio.shield(future)
+
+	def flush(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if len(self.pending) == 0:
+			return
+		batch = self.pending
+		self.pending = {}
+		task = asyncio.create_task(self.run(batch))
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+
+	async def run(self, batch):
+		keys = list(batch)
+		self.batches += 1
+		self.items += len(keys)
+		self.largest_batch = max(self.largest_batch, len(keys))
+		try:
+			results = await self.fetch(keys)
+		except Exception as e:
+			logger.warning("Batch of %d failed: %s", len(keys), e)
+			for future in batch.values():
+				if not future.done():
+					future.set_exception(e)
+					future.exception()
+			return
+		for key, result in zip(keys, results):
+			if not batch[key].done():
+				batch[key].set_result(result)
+		for future in batch.values():
+			if not future.done():
+				future.set_exception(LookupError("Missing result in batch"))
+				future.exception()
+
+	def metrics(self):
+		return {
+			"pending": len(self.pending),
+			"batches": self.batches,
+			"items": self.items,
+			"largest_batch": self.largest_batch,
+			"average_batch": self.items / self.batches if self.batches != 0 else 0
+		}
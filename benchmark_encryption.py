@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+import tracemalloc
+
+from SMM2 import encryption
+
+# Compares the buffer based encryption functions with the original ones.
+# Takes .bcd files on the command line, or encrypts a random course when none are given
+
+runs = 50
+
+files = []
+for path in sys.argv[1:]:
+	with open(path, "rb") as f:
+		files.append(f.read())
+if len(files) == 0:
+	files.append(encryption.encrypt_bcd(os.urandom(0x5bfc0)))
+
+def measure(name, function, inputs):
+	function(*inputs[0])
+	tracemalloc.start()
+	start = time.perf_counter()
+	for i in range(runs):
+		for arguments in inputs:
+			function(*arguments)
+	elapsed = time.perf_counter() - start
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	print("%-24s %8.3f ms per course, %6d KiB peak" % (name, elapsed * 1000 / (runs * len(files)), peak // 1024))
+
+decrypted = bytearray(0x5bfc0)
+encrypted = bytearray(encryption.BCD_SIZE)
+# The decrypted course with the header, iv and seed that encrypt it back into the same file
+courses = [(encryption.decrypt_bcd(data),) + encryption.split_bcd(data) for data in files]
+
+measure("decrypt_bcd", encryption.decrypt_bcd, [(data,) for data in files])
+measure("decrypt_bcd_buffer", lambda data: encryption.decrypt_bcd_buffer(data, decrypted), [(data,) for data in files])
+measure("encrypt_bcd", lambda data, header, iv, seed: encryption.encrypt_bcd(data, header=header, iv=iv, seed=seed), courses)
+measure("encrypt_bcd_buffer", lambda data, header, iv, seed: encryption.encrypt_bcd_buffer(data, encrypted, header, iv, seed), courses)
@@ -0,0 +1,237 @@
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Every value is a zlib compressed JSON blob, exactly what used to be written to cache/<namespace>/<key>
+NAMESPACES = ["level_info", "user_info", "level_comments", "super_worlds", "level_parsed"]
+
+def private_opener(path, flags):
+	return os.open(path, flags, 0o600)
+
+def atomic_write(path, data, stored_at = None, private = False):
+	# Written next to the destination and renamed over it, so other workers
+	# reading the file see either the old or the new contents
+	tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+	try:
+		with open(tmp, mode="wb", opener=private_opener if private else None) as f:
+			f.write(data)
+		if stored_at is not None:
+			os.utime(tmp, (stored_at, stored_at))
+		os.replace(tmp, path)
+	except:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
+class CacheBackend:
+	def get(self, namespace, key):
+		entry = self.get_entry(namespace, key)
+		if entry is None:
+			return None
+		return entry[0]
+
+	def get_entry(self, namespace, key):
+		# Returns the value and the unix time it was stored at
+		raise NotImplementedError()
+
+	def contains(self, namespace, key):
+		return self.get(namespace, key) is not None
+
+	def put(self, namespace, key, value, stored_at = None):
+		raise NotImplementedError()
+
+	def put_many(self, namespace, items, stored_at = None):
+		for key, value in items:
+			self.put(namespace, key, value, stored_at)
+
+	def flush_due(self):
+		return False
+
+	def flush(self):
+		pass
+
+	def close(self):
+		self.flush()
+
+class FileCacheBackend(CacheBackend):
+	# The original layout, one file per entry
+	def __init__(self, root = "cache"):
+		self.root = root
+
+	def path(self, namespace, key):
+		return os.path.join(self.root, namespace, str(key))
+
+	def get_entry(self, namespace, key):
+		try:
+			with open(self.path(namespace, key), mode="rb") as f:
+				return f.read(), os.fstat(f.fileno()).st_mtime
+		except FileNotFoundError:
+			return None
+
+	def contains(self, namespace, key):
+		return pathlib.Path(self.path(namespace, key)).exists()
+
+	def put(self, namespace, key, value, stored_at = None):
+		os.makedirs(os.path.join(self.root, namespace), exist_ok=True)
+		atomic_write(self.path(namespace, key), value, stored_at)
+
+class SQLiteCacheBackend(CacheBackend):
+	def __init__(self, path = "cache/cache.sqlite3", batch_size = 100, flush_interval = 1.0):
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		self.path = path
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.pending = {}
+		# Entries being committed, still served from memory until the commit is done
+		self.flushing = {}
+		self.last_flush = time.monotonic()
+		self.lock = threading.RLock()
+		self.write_lock = threading.Lock()
+
+		# Every worker process has its own connections, wait for the others instead of failing on their writes.
+		# Writes use their own connection so a commit waiting for another worker never holds up reads
+		self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.writer = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+		self.writer.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+			namespace TEXT NOT NULL,
+			key TEXT NOT NULL,
+			value BLOB NOT NULL,
+			stored_at REAL NOT NULL,
+			PRIMARY KEY (namespace, key)
+		) WITHOUT ROWID""")
+
+	def get_entry(self, namespace, key):
+		key = str(key)
+		with self.lock:
+			if (namespace, key) in self.pending:
+				return self.pending[(namespace, key)]
+			if (namespace, key) in self.flushing:
+				return self.flushing[(namespace, key)]
+			row = self.db.execute("SELECT value, stored_at FROM entries WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+		if row is None:
+			return None
+		return row[0], row[1]
+
+	def contains(self, namespace, key):
+		key = str(key)
+		with self.lock:
+			if (namespace, key) in self.pending or (namespace, key) in self.flushing:
+				return True
+			row = self.db.execute("SELECT 1 FROM entries WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+		return row is not None
+
+	def put(self, namespace, key, value, stored_at = None):
+		self.put_many(namespace, [(key, value)], stored_at)
+
+	def put_many(self, namespace, items, stored_at = None):
+		if stored_at is None:
+			stored_at = time.time()
+		# Writes are grouped into one transaction instead of committing each entry,
+		# whoever owns the backend calls flush once flush_due says so
+		with self.lock:
+			for key, value in items:
+				self.pending[(namespace, str(key))] = (value, stored_at)
+
+	def flush_due(self):
+		with self.lock:
+			return len(self.pending) >= self.batch_size or (len(self.pending) != 0 and (time.monotonic() - self.last_flush) > self.flush_interval)
+
+	def flush(self):
+		# Safe to run in another thread, reads are only blocked while the pending entries are swapped out
+		with self.write_lock:
+			with self.lock:
+				self.last_flush = time.monotonic()
+				if len(self.pending) == 0:
+					return
+				self.flushing = self.pending
+				self.pending = {}
+			rows = [(namespace, key, value, stored_at) for (namespace, key), (value, stored_at) in self.flushing.items()]
+			try:
+				self.writer.execute("BEGIN")
+				try:
+					self.writer.executemany("INSERT OR REPLACE INTO entries (namespace, key, value, stored_at) VALUES (?, ?, ?, ?)", rows)
+					self.writer.execute("COMMIT")
+				except:
+					self.writer.execute("ROLLBACK")
+					raise
+			except:
+				with self.lock:
+					# Tried again on the next flush, entries written meanwhile are newer
+					self.flushing.update(self.pending)
+					self.pending = self.flushing
+				raise
+			finally:
+				with self.lock:
+					self.flushing = {}
+
+	def close(self):
+		self.flush()
+		self.writer.close()
+		self.db.close()
+
+class LRUCache:
+	# In memory tier in front of a backend, bounded by the total size of the stored values
+	ENTRY_OVERHEAD = 200
+
+	def __init__(self, max_bytes = 256 * 1024 * 1024):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return entry[0]
+
+	def put(self, key, value, size):
+		size += self.ENTRY_OVERHEAD
+		if size > self.max_bytes:
+			self.discard(key)
+			return
+		with self.lock:
+			if key in self.entries:
+				self.size -= self.entries.pop(key)[1]
+			self.entries[key] = (value, size)
+			self.size += size
+			while self.size > self.max_bytes:
+				_, (_, evicted_size) = self.entries.popitem(last=False)
+				self.size -= evicted_size
+				self.evictions += 1
+
+	def discard(self, key):
+		with self.lock:
+			if key in self.entries:
+				self.size -= self.entries.pop(key)[1]
+
+	def metrics(self):
+		return {
+			"entries": len(self.entries),
+			"bytes": self.size,
+			"max_bytes": self.max_bytes,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions
+		}
+
+def open_cache(backend = "sqlite", path = None):
+	if backend == "files":
+		return FileCacheBackend(path or "cache")
+	if backend == "sqlite":
+		return SQLiteCacheBackend(path or "cache/cache.sqlite3")
+	raise ValueError("Unknown cache backend %s" % backend)
@@ -0,0 +1,96 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+class CPUExecutor:
+	def __init__(self, kind = "thread", workers = None, max_queue = 64):
+		# Runs image, crypto and compression work away from the event loop.
+		# With kind "process" run() sends work to worker processes, which only takes module level
+		# functions with arguments that can be pickled (see cpu_tasks.py). run_thread() always uses
+		# threads, for work on objects shared with the server. At most workers + max_queue calls are
+		# handed to the pools at once, the others wait here so a burst cannot queue up without limit
+		self.kind = kind
+		self.workers = workers or os.cpu_count() or 1
+		self.max_queue = max_queue
+		self.threads = ThreadPoolExecutor(self.workers, thread_name_prefix="cpu")
+		self.processes = self.process_pool() if kind == "process" else None
+		self.slots = None
+
+		self.waiting = 0
+		self.running = 0
+		self.operations = {}
+
+	def process_pool(self):
+		# Spawned, forking the server while its other threads run is not safe
+		return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+	async def run(self, operation, function, *args):
+		return await self.submit(self.processes or self.threads, operation, function, args)
+
+	async def run_thread(self, operation, function, *args):
+		return await self.submit(self.threads, operation, function, args)
+
+	async def submit(self, executor, operation, function, args):
+		if self.slots is None:
+			self.slots = asyncio.Semaphore(self.workers + self.max_queue)
+		if operation not in self.operations:
+			self.operations[operation] = {"calls": 0, "errors": 0, "wait": 0, "time": 0, "max_time": 0}
+		stats = self.operations[operation]
+
+		queued = time.monotonic()
+		self.waiting += 1
+		try:
+			await self.slots.acquire()
+		finally:
+			self.waiting -= 1
+
+		start = time.monotonic()
+		self.running += 1
+		try:
+			return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+		except BrokenProcessPool:
+			# A worker died and took the pool with it, the next calls get a new one
+			stats["errors"] += 1
+			if executor is self.processes:
+				logger.warning("CPU worker process died, restarting the pool")
+				# Lets the broken pool clean up its remaining processes and management thread
+				executor.shutdown(wait=False)
+				self.processes = self.process_pool()
+			raise
+		except Exception:
+			stats["errors"] += 1
+			raise
+		finally:
+			self.running -= 1
+			self.slots.release()
+			elapsed = time.monotonic() - start
+			stats["calls"] += 1
+			stats["wait"] += start - queued
+			stats["time"] += elapsed
+			stats["max_time"] = max(stats["max_time"], elapsed)
+
+	def close(self):
+		self.threads.shutdown(wait=False)
+		if self.processes is not None:
+			self.processes.shutdown(wait=False)
+
+	def metrics(self):
+		return {
+			"kind": self.kind,
+			"workers": self.workers,
+			"waiting": self.waiting,
+			"running": self.running,
+			"operations": {operation: {
+				"calls": stats["calls"],
+				"errors": stats["errors"],
+				"average_wait": stats["wait"] / stats["calls"] if stats["calls"] != 0 else None,
+				"average_time": stats["time"] / stats["calls"] if stats["calls"] != 0 else None,
+				"max_time": stats["max_time"]
+			} for operation, stats in self.operations.items()}
+		}
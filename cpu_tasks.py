@@ -0,0 +1,97 @@
+import io
+import zlib
+from binascii import hexlify
+from struct import pack
+
+from PIL import Image
+
+from gen3_switchgame import Gen3Switchgame
+
+# Work run on the CPU executor. Worker processes import this module to find these functions,
+# so it must not do anything when imported
+
+def get_mii_data(data):
+	# Based on https://github.com/HEYimHeroic/mii2studio/blob/master/mii2studio.py
+	user_mii = Gen3Switchgame.from_bytes(data)
+	mii_values = [
+		user_mii.facial_hair_color,
+		user_mii.facial_hair_beard,
+		user_mii.body_weight,
+		user_mii.eye_stretch,
+		user_mii.eye_color,
+		user_mii.eye_rotation,
+		user_mii.eye_size,
+		user_mii.eye_type,
+		user_mii.eye_horizontal,
+		user_mii.eye_vertical,
+		user_mii.eyebrow_stretch,
+		user_mii.eyebrow_color,
+		user_mii.eyebrow_rotation,
+		user_mii.eyebrow_size,
+		user_mii.eyebrow_type,
+		user_mii.eyebrow_horizontal,
+		user_mii.eyebrow_vertical,
+		user_mii.face_color,
+		user_mii.face_makeup,
+		user_mii.face_type,
+		user_mii.face_wrinkles,
+		user_mii.favorite_color,
+		user_mii.gender,
+		user_mii.glasses_color,
+		user_mii.glasses_size,
+		user_mii.glasses_type,
+		user_mii.glasses_vertical,
+		user_mii.hair_color,
+		user_mii.hair_flip,
+		user_mii.hair_type,
+		user_mii.body_height,
+		user_mii.mole_size,
+		user_mii.mole_enable,
+		user_mii.mole_horizontal,
+		user_mii.mole_vertical,
+		user_mii.mouth_stretch,
+		user_mii.mouth_color,
+		user_mii.mouth_size,
+		user_mii.mouth_type,
+		user_mii.mouth_vertical,
+		user_mii.facial_hair_size,
+		user_mii.facial_hair_mustache,
+		user_mii.facial_hair_vertical,
+		user_mii.nose_size,
+		user_mii.nose_type,
+		user_mii.nose_vertical
+	]
+
+	mii_data = b"00"
+	mii_bytes = ""
+	n = 256
+	for v in mii_values:
+		n = (7 + (v ^ n)) % 256
+		mii_data += hexlify(pack(">B", n))
+		mii_bytes += hexlify(pack(">B", v)).decode("ascii")
+
+	url = "https://studio.mii.nintendo.com/miis/image.png?data=" + mii_data.decode("utf-8")
+	return [url + "&type=face&width=512&instanceCount=1", mii_bytes]
+
+def get_mii_data_many(datas):
+	# One call for a whole page of users, empty Mii data gives None
+	return [get_mii_data(data) if len(data) != 0 else None for data in datas]
+
+def reencode_jpeg(body):
+	image = Image.open(io.BytesIO(body))
+	image_bytes = io.BytesIO()
+	image.save(image_bytes, optimize=True, quality=95, format="jpeg")
+	return image_bytes.getvalue()
+
+def resize_jpeg(body, width):
+	image = Image.open(io.BytesIO(body))
+	height = max(1, image.height * width // image.width)
+	# Lets the JPEG decoder skip detail that would be thrown away, much faster than decoding the full image
+	image.draft("RGB", (width, height))
+	image = image.convert("RGB").resize((width, height), Image.LANCZOS)
+	image_bytes = io.BytesIO()
+	image.save(image_bytes, optimize=True, quality=90, format="jpeg")
+	return image_bytes.getvalue()
+
+def compress_many(contents):
+	return [zlib.compress(content) for content in contents]
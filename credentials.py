@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+class CredentialManager:
+	def __init__(self, generate_device_tokens, generate_id_token, prepare = None, token_store = None, device_token_lifetime = 85340,
+		id_token_lifetime = 1044, refresh_ahead = 0.1, retry_min = 5, retry_max = 600, on_refresh = None):
+		# generate_device_tokens() returns a dict with the device and app tokens,
+		# generate_id_token(tokens) returns a dict with the id token and account built from them.
+		# Both only return JSON values so they can be shared through token_store, prepare(tokens)
+		# adds whatever each process needs to log in with them.
+		# Lifetimes are in seconds, tokens are renewed once refresh_ahead of their lifetime is left
+		self.generate_device_tokens = generate_device_tokens
+		self.generate_id_token = generate_id_token
+		self.prepare = prepare
+		self.token_store = token_store
+		self.device_token_lifetime = device_token_lifetime
+		self.id_token_lifetime = id_token_lifetime
+		self.refresh_ahead = refresh_ahead
+		self.retry_min = retry_min
+		self.retry_max = retry_max
+		self.on_refresh = on_refresh
+
+		self.tokens = None
+		self.current = None
+		self.device_token_generated_time = None
+		self.id_token_generated_time = None
+		self.ready = None
+		self.task = None
+		self.next_refresh = None
+
+		self.refreshes = 0
+		self.adopted = 0
+		self.failures = 0
+		self.consecutive_failures = 0
+		self.last_error = None
+
+	def start(self):
+		if self.ready is None:
+			self.ready = asyncio.Event()
+		if self.task is None or self.task.done():
+			self.task = asyncio.create_task(self.run())
+
+	async def get(self):
+		# Only waits before the first login, afterwards the tokens in use are always returned
+		# while new ones are generated in the background
+		self.start()
+		if self.current is None and self.last_error is not None:
+			# The first login failed and is retried after a backoff, don't hold the request until then
+			raise ConnectionError("Could not log in: %s" % self.last_error)
+		if self.current is None:
+			await self.ready.wait()
+			if self.current is None:
+				raise ConnectionError("Could not log in: %s" % self.last_error)
+		return self.current
+
+	def due(self, generated_time, lifetime):
+		return generated_time + lifetime * (1 - self.refresh_ahead)
+
+	async def run(self):
+		while True:
+			try:
+				await self.refresh()
+				self.consecutive_failures = 0
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				self.failures += 1
+				self.consecutive_failures += 1
+				self.last_error = str(e)
+				delay = min(self.retry_max, self.retry_min * 2 ** (self.consecutive_failures - 1))
+				logger.warning("Refreshing credentials failed, retrying in %d seconds: %s", delay, e)
+				if self.current is None:
+					# Fail the requests waiting for the first login instead of holding them through the backoff
+					self.ready.set()
+					self.ready = asyncio.Event()
+				self.next_refresh = time.time() + delay
+				await asyncio.sleep(delay)
+				continue
+
+			self.next_refresh = min(self.due(self.device_token_generated_time, self.device_token_lifetime),
+				self.due(self.id_token_generated_time, self.id_token_lifetime))
+			await asyncio.sleep(max(0, self.next_refresh - time.time()))
+
+	async def refresh(self):
+		if self.token_store is None:
+			await self.renew()
+			return
+
+		# Only one process generates tokens, the others wait for the lock and use what it saved
+		loop = asyncio.get_running_loop()
+		lock = await loop.run_in_executor(None, self.token_store.lock)
+		try:
+			shared = await loop.run_in_executor(None, self.token_store.load)
+			if shared is not None and (self.id_token_generated_time is None or shared["id_token_generated_time"] > self.id_token_generated_time):
+				self.apply(shared["tokens"], shared["device_token_generated_time"], shared["id_token_generated_time"])
+				self.adopted += 1
+			if await self.renew():
+				await loop.run_in_executor(None, self.token_store.save, {
+					"tokens": self.tokens,
+					"device_token_generated_time": self.device_token_generated_time,
+					"id_token_generated_time": self.id_token_generated_time
+				})
+		finally:
+			self.token_store.unlock(lock)
+
+	async def renew(self):
+		now = time.time()
+		tokens = self.tokens
+		device_token_generated_time = self.device_token_generated_time
+		if tokens is None or now >= self.due(self.device_token_generated_time, self.device_token_lifetime):
+			print("Generate device token")
+			tokens = await self.generate_device_tokens()
+			device_token_generated_time = time.time()
+		elif now < self.due(self.id_token_generated_time, self.id_token_lifetime):
+			return False
+
+		print("Generate id token")
+		new = dict(tokens)
+		new.update(await self.generate_id_token(tokens))
+		self.apply(new, device_token_generated_time, time.time())
+		self.refreshes += 1
+		return True
+
+	def apply(self, tokens, device_token_generated_time, id_token_generated_time):
+		current = dict(tokens)
+		if self.prepare is not None:
+			current.update(self.prepare(tokens))
+
+		# Swapped in as a whole, requests never see tokens from two different logins
+		self.tokens = tokens
+		self.current = current
+		self.device_token_generated_time = device_token_generated_time
+		self.id_token_generated_time = id_token_generated_time
+		self.last_error = None
+		self.ready.set()
+		if self.on_refresh is not None:
+			self.on_refresh()
+		print("Ready to go!")
+
+	def metrics(self):
+		now = time.time()
+		return {
+			"ready": self.current is not None,
+			"device_token_age": now - self.device_token_generated_time if self.device_token_generated_time is not None else None,
+			"id_token_age": now - self.id_token_generated_time if self.id_token_generated_time is not None else None,
+			"next_refresh_in": self.next_refresh - now if self.next_refresh is not None else None,
+			"refreshes": self.refreshes,
+			"adopted": self.adopted,
+			"failures": self.failures,
+			"consecutive_failures": self.consecutive_failures,
+			"last_error": self.last_error
+		}
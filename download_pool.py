@@ -0,0 +1,103 @@
+import asyncio
+import http.client
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+class DownloadError(Exception):
+	def __init__(self, url, status):
+		super().__init__("HTTP %d for %s" % (status, url))
+		self.url = url
+		self.status = status
+
+class DownloadPool:
+	def __init__(self, size = 16, timeout = 30):
+		# Plain HTTPS downloads from Nintendo's CDN, apart from the NEX sessions.
+		# Every thread keeps its connections open so they are reused between downloads
+		self.size = size
+		self.timeout = timeout
+		self.executor = ThreadPoolExecutor(size, thread_name_prefix="download")
+		self.local = threading.local()
+		self.lock = threading.Lock()
+
+		self.in_flight = 0
+		self.downloads = 0
+		self.bytes = 0
+		self.connects = 0
+		self.reused = 0
+		self.failures = 0
+
+	async def get(self, url, headers = None):
+		with self.lock:
+			self.in_flight += 1
+		try:
+			return await asyncio.get_running_loop().run_in_executor(self.executor, self.fetch, url, headers or {})
+		finally:
+			with self.lock:
+				self.in_flight -= 1
+
+	def connection(self, scheme, host):
+		if not hasattr(self.local, "connections"):
+			self.local.connections = {}
+		connection = self.local.connections.get((scheme, host))
+		if connection is not None:
+			return connection, True
+		if scheme == "https":
+			connection = http.client.HTTPSConnection(host, timeout=self.timeout)
+		else:
+			connection = http.client.HTTPConnection(host, timeout=self.timeout)
+		self.local.connections[(scheme, host)] = connection
+		with self.lock:
+			self.connects += 1
+		return connection, False
+
+	def drop(self, scheme, host):
+		connection = self.local.connections.pop((scheme, host), None)
+		if connection is not None:
+			connection.close()
+
+	def fetch(self, url, headers):
+		parts = urllib.parse.urlsplit(url)
+		path = parts.path or "/"
+		if parts.query:
+			path += "?" + parts.query
+
+		while True:
+			connection, reused = self.connection(parts.scheme, parts.netloc)
+			try:
+				connection.request("GET", path, headers=headers)
+				response = connection.getresponse()
+				body = response.read()
+			except (http.client.HTTPException, OSError):
+				self.drop(parts.scheme, parts.netloc)
+				if reused:
+					# The server closed the idle connection, try again on a new one
+					continue
+				with self.lock:
+					self.failures += 1
+				raise
+
+			if response.will_close:
+				self.drop(parts.scheme, parts.netloc)
+			with self.lock:
+				if reused:
+					self.reused += 1
+				if response.status >= 400:
+					self.failures += 1
+				else:
+					self.downloads += 1
+					self.bytes += len(body)
+			if response.status >= 400:
+				raise DownloadError(url, response.status)
+			return body
+
+	def metrics(self):
+		return {
+			"size": self.size,
+			"in_flight": self.in_flight,
+			"downloads": self.downloads,
+			"bytes": self.bytes,
+			"connects": self.connects,
+			"reused": self.reused,
+			"failures": self.failures
+		}
@@ -0,0 +1,144 @@
+import asyncio
+import fcntl
+import json
+import os
+from collections import deque
+
+from cache_store import atomic_write
+
+import logging
+logger = logging.getLogger(__name__)
+
+class CourseFollower:
+	def __init__(self, fetch_latest, interval = 10, page_size = 100, max_pages = 10, feed_size = 2000, shared_path = None):
+		# fetch_latest(offset, size) returns course JSON objects, newest first.
+		# With shared_path only the worker process holding its lock polls, the feed it finds
+		# is written to shared_path and the other workers read it from there
+		self.fetch_latest = fetch_latest
+		self.shared_path = shared_path
+		self.lock_fd = None
+		self.shared_mtime = None
+		self.interval = interval
+		self.page_size = page_size
+		self.max_pages = max_pages
+
+		self.high_water = None
+		self.recent = deque(maxlen=feed_size)
+		self.updated = None
+		self.task = None
+
+		self.polls = 0
+		self.failed_polls = 0
+		self.new_courses = 0
+		self.gaps = 0
+
+	def start(self):
+		if self.updated is None:
+			self.updated = asyncio.Event()
+		if self.task is None or self.task.done():
+			self.task = asyncio.create_task(self.run())
+
+	def lead(self):
+		# Never blocks, a worker that doesn't get the lock tries again on the next round
+		# and takes over once the polling worker exits
+		if self.shared_path is None or self.lock_fd is not None:
+			return True
+		fd = os.open(self.shared_path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			os.close(fd)
+			return False
+		logger.info("Following the latest courses in this worker")
+		self.lock_fd = fd
+		return True
+
+	async def run(self):
+		while True:
+			try:
+				if self.lead():
+					await self.poll()
+				else:
+					self.load_shared()
+			except Exception as e:
+				self.failed_polls += 1
+				logger.warning("Following the latest courses failed: %s", e)
+			await asyncio.sleep(self.interval)
+
+	async def poll(self):
+		# Pages back until reaching courses that were already seen
+		new = []
+		for page in range(self.max_pages):
+			courses = await self.fetch_latest(page * self.page_size, self.page_size)
+			fresh = [course for course in courses if self.high_water is None or course["data_id"] > self.high_water]
+			new += fresh
+			if self.high_water is None or len(fresh) < len(courses) or len(courses) < self.page_size:
+				break
+		else:
+			# More uploads than max_pages pages since the last poll, some were missed
+			self.gaps += 1
+		self.polls += 1
+
+		if len(new) == 0:
+			return
+		new.sort(key=lambda course: course["data_id"])
+		# Only courses uploaded after the follower started are part of the feed
+		if self.high_water is not None:
+			self.recent.extend(new)
+			self.new_courses += len(new)
+		self.high_water = max(new[-1]["data_id"], self.high_water or 0)
+		self.wake()
+
+		if self.shared_path is not None:
+			atomic_write(self.shared_path, json.dumps({"high_water": self.high_water, "courses": list(self.recent)}).encode("utf-8"))
+
+	def load_shared(self):
+		try:
+			mtime = os.stat(self.shared_path).st_mtime_ns
+			if mtime == self.shared_mtime:
+				return
+			with open(self.shared_path) as f:
+				shared = json.load(f)
+		except (FileNotFoundError, ValueError):
+			return
+		self.shared_mtime = mtime
+		self.polls += 1
+
+		new = [course for course in shared["courses"] if self.high_water is None or course["data_id"] > self.high_water]
+		self.recent.extend(new)
+		self.new_courses += len(new)
+		if len(new) == 0 and shared["high_water"] == self.high_water:
+			return
+		self.high_water = max(shared["high_water"], self.high_water or 0)
+		self.wake()
+
+	def wake(self):
+		# Wake everyone waiting for new courses
+		self.updated.set()
+		self.updated = asyncio.Event()
+
+	def since(self, data_id):
+		return [course for course in self.recent if course["data_id"] > data_id]
+
+	async def wait(self, data_id, timeout):
+		# Returns the courses newer than data_id, waiting up to timeout seconds for some to show up
+		self.start()
+		courses = self.since(data_id)
+		if len(courses) == 0:
+			try:
+				await asyncio.wait_for(self.updated.wait(), timeout)
+			except asyncio.TimeoutError:
+				return []
+			courses = self.since(data_id)
+		return courses
+
+	def metrics(self):
+		return {
+			"polling": self.lock_fd is not None or self.shared_path is None,
+			"high_water": self.high_water,
+			"feed": len(self.recent),
+			"polls": self.polls,
+			"failed_polls": self.failed_polls,
+			"new_courses": self.new_courses,
+			"gaps": self.gaps
+		}
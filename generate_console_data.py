@@ -1,4 +1,7 @@
 import asyncio
+import json
+import os
+import sys
 
 from anynet import tls
 from nintendo import switch
@@ -11,18 +14,37 @@ logging.basicConfig(level=logging.INFO)
 
 SMM2_TITLE_ID = 0x01009B90006DC000
 
-username = None
-password = None
-with open("ConsoleData/8000000000000010", mode="rb") as file:
-	data = file.read()
-	username_bytes = bytearray(data[0x00084020:0x00084028])
-	username_bytes.reverse()
-	username = "0x" + username_bytes.hex().upper()
-	password = data[0x00084028:0x00084050].decode("ascii")
+# Every directory given on the command line holds the dumps of one console, the same
+# layout as ConsoleData. More than one directory writes a config with several identities
+console_dirs = sys.argv[1:]
+if len(console_dirs) == 0:
+	console_dirs = ["./ConsoleData"]
 
-async def create_args():
-	keys = switch.load_keys("./ConsoleData/prod.keys")
-	info = switch.ProdInfo(keys, "./ConsoleData/PRODINFO.dec")
+def identity_names(console_dirs):
+	# Identities are named after their directories, numbered when two directories have the same name
+	names = [os.path.basename(os.path.abspath(console_dir)) for console_dir in console_dirs]
+	names = [name if names.count(name) == 1 else "%s-%d" % (name, i + 1) for i, name in enumerate(names)]
+	if len(set(names)) != len(names):
+		logging.critical("Console directories need different names: %s" % ", ".join(console_dirs))
+		sys.exit(1)
+	return names
+
+def read_account(console_dir):
+	with open(os.path.join(console_dir, "8000000000000010"), mode="rb") as file:
+		data = file.read()
+		username_bytes = bytearray(data[0x00084020:0x00084028])
+		username_bytes.reverse()
+		username = "0x" + username_bytes.hex().upper()
+		password = data[0x00084028:0x00084050].decode("ascii")
+	return username, password
+
+async def create_identity(console_dir, name):
+	username, password = read_account(console_dir)
+	keys_path = os.path.join(console_dir, "prod.keys")
+	prodinfo_path = os.path.join(console_dir, "PRODINFO.dec")
+
+	keys = switch.load_keys(keys_path)
+	info = switch.ProdInfo(keys, prodinfo_path)
 	cert = info.get_tls_cert()
 	#with open("cert.pem", mode="wb") as cert_file:
 	#	cert_file.write(cert.encode(tls.TYPE_PEM))
@@ -36,7 +58,7 @@ async def create_args():
 
 	# Obtain device ID from prodinfo
 	device_id = None
-	with open("ConsoleData/PRODINFO.dec", mode="rb") as file:
+	with open(prodinfo_path, mode="rb") as file:
 		data = file.read()
 		# It doesn't appear to matter what the device_id is
 		device_id = int(data[0x546:0x556].decode("ascii"), 16)
@@ -61,23 +83,42 @@ async def create_args():
 	# There are many valid, just choose the first that is active
 	for possible_license in response["elicenses"]:
 		if possible_license["status"] == "active" and int(possible_license["rights_id"], 16) == SMM2_TITLE_ID:
-			with open("webserver_args.json", mode="w") as file:
-				args = """{
-	"system_version": %d,
-	"user_id": "%s",
-	"password": "%s",
-	"keys": "./ConsoleData/prod.keys",
-	"prodinfo": "./ConsoleData/PRODINFO.dec",
-	"ticket": "./ConsoleData/SUPER MARIO MAKER 2 v0 (01009B90006DC000) (BASE).tik",
-	"elicense_id": "%s",
-	"na_id": "%s"
-}""" % (LATEST_VERSION, username, password, possible_license["elicense_id"], possible_license["account_id"])
-				file.write(args)
-			return
-	
+			return {
+				"name": name,
+				"user_id": username,
+				"password": password,
+				"keys": keys_path,
+				"prodinfo": prodinfo_path,
+				"elicense_id": possible_license["elicense_id"],
+				"na_id": possible_license["account_id"]
+			}
+
 	# If here, no elicense found
-	logging.critical("NO ELICENSE FOUND ON THIS DEVICE FOR SUPER MARIO MAKER 2")
+	logging.critical("NO ELICENSE FOUND ON %s FOR SUPER MARIO MAKER 2" % console_dir)
 	logging.critical("Consider using Charles or another MITM proxy to find the elicense_id and na_id")
 	logging.critical("Additionally, ensure this switch is the primary switch")
+	return None
+
+async def create_args():
+	identities = []
+	for console_dir, name in zip(console_dirs, identity_names(console_dirs)):
+		identity = await create_identity(console_dir, name)
+		if identity is not None:
+			identities.append(identity)
+
+	if len(identities) == 0:
+		return
+
+	args = {"system_version": LATEST_VERSION}
+	if len(console_dirs) == 1:
+		# Same layout as before, one identity at the top level
+		del identities[0]["name"]
+		args.update(identities[0])
+		args["ticket"] = os.path.join(console_dirs[0], "SUPER MARIO MAKER 2 v0 (01009B90006DC000) (BASE).tik")
+	else:
+		args["identities"] = identities
+
+	with open("webserver_args.json", mode="w") as file:
+		file.write(json.dumps(args, indent="\t"))
 
-asyncio.run(create_args())
\ No newline at end of file
+asyncio.run(create_args())
@@ -1,30 +1,42 @@
 import pathlib
 import asyncio
 import time
-from threading import Thread
 import os
 import json
 import orjson
 import os
 import time
-from binascii import hexlify
+import struct
 from struct import pack
-from PIL import Image
 import zlib
 import base64
-import io
-from fastapi import FastAPI
-from fastapi.responses import Response, ORJSONResponse, FileResponse
+import contextlib
+import collections
+import tarfile
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, ORJSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from gen3_switchgame import Gen3Switchgame
+from session_pool import SessionPool, ShardedSessionPool
+from singleflight import SingleFlight
+from batcher import MicroBatcher
+from credentials import CredentialManager
+from token_store import TokenStore
+from limiter import AdaptiveLimiter, TimedStore
+from follower import CourseFollower
+from download_pool import DownloadPool
+from level_store import LevelStore
+from cpu_executor import CPUExecutor
+from cpu_tasks import get_mii_data, get_mii_data_many, reencode_jpeg, resize_jpeg, compress_many
+from cache_store import open_cache, atomic_write, LRUCache
+from SMM2 import encryption
+from SMM2.level import parse_level
 from nintendo import switch
 from nintendo.baas import BAASClient
 from nintendo.dauth import DAuthClient
 from nintendo.dragons import DragonsClient
 from nintendo.aauth import AAuthClient
 from nintendo.nex import backend, authentication, settings, datastore_smm2 as datastore
-from anynet import http
 from enum import IntEnum
 
 # https://github.com/kinnay/NintendoClients/blob/ab2b63a05c28e0939f1e93f2c576e3d7ca9db416/nintendo/games.py
@@ -43,63 +55,37 @@ args = {}
 with open("webserver_args.json") as f:
 	args = json.load(f)
 
-if args["system_version"] is None:
-	print("System version not set")
-	print("Error")
-	exit(1)
+class Identity:
+	# One console and Nintendo account the server logs in with, every identity
+	# has its own tokens and NEX sessions because Nintendo rate limits per account
+	def __init__(self, name, config):
+		self.name = name
+
+		# Fields missing from an identity are taken from the top level of webserver_args.json
+		def get_arg(field, description):
+			value = config.get(field, args.get(field))
+			if value is None:
+				print("%s not set for %s" % (description, name))
+				print("Error")
+				exit(1)
+			return value
+
+		self.system_version = get_arg("system_version", "System version")
+		self.baas_user_id = int(get_arg("user_id", "User ID"), 16)
+		self.baas_password = get_arg("password", "Password")
+		self.keys = switch.load_keys(get_arg("keys", "Prod.keys"))
+		self.info = switch.ProdInfo(self.keys, get_arg("prodinfo", "Prodinfo"))
+		self.elicense_id = get_arg("elicense_id", "Elicense ID")
+		self.na_id = int(get_arg("na_id", "NA ID"), 16)
+
+if "identities" in args:
+	identity_configs = args["identities"]
 else:
-	SYSTEM_VERSION = args["system_version"]
+	identity_configs = [{}]
 
-if args["user_id"] is None:
-	print("User ID not set")
-	print("Error")
-	exit(1)
-else:
-	BAAS_USER_ID = int(args["user_id"], 16)
-
-if args["password"] is None:
-	print("Password not set")
-	print("Error")
-	exit(1)
-else:
-	BAAS_PASSWORD = args["password"]
-
-if args["keys"] is None:
-	print("Prod.keys not set")
-	print("Error")
-	exit(1)
-else:
-	keys = switch.load_keys(args["keys"])
-
-if args["prodinfo"] is None:
-	print("Prodinfo not set")
-	print("Error")
-	exit(1)
-else:
-	info = switch.ProdInfo(keys, args["prodinfo"])
-
-# NOTE ticket is no longer used
-if args["ticket"] is None:
-	print("Ticket not set")
-	print("Error")
-	exit(1)
-else:
-	with open(args["ticket"], "rb") as f:
-		ticket = f.read()
-
-if args["elicense_id"] is None:
-	print("Elicense ID not set")
-	print("Error")
-	exit(1)
-else:
-	ELICENSE_ID = args["elicense_id"]
-
-if args["na_id"] is None:
-	print("NA ID not set")
-	print("Error")
-	exit(1)
-else:
-	NA_ID = int(args["na_id"], 16)
+identity_list = []
+for i, identity_config in enumerate(identity_configs):
+	identity_list.append(Identity(identity_config.get("name", "identity%d" % i), identity_config))
 
 # Used for scraping
 debug_enabled = False
@@ -140,18 +126,19 @@ class ServerDataTypeHeader:
 		self.headers = {h.key: h.value for h in headers_info.headers}
 		self.expiration = headers_info.expiration * 1000
 		self.last_updated = milliseconds_since_epoch()
+	def expired(self):
+		return (milliseconds_since_epoch() - self.last_updated) > (self.expiration - 1000)
 	async def refresh_if_needed(self, store):
-		if (milliseconds_since_epoch() - self.last_updated) > (self.expiration - 1000):
+		if self.expired():
 			await self.refresh(store)
 	async def request_url(self, url, store):
-		if (milliseconds_since_epoch() - self.last_updated) > (self.expiration - 1000):
+		if self.expired():
 			if store == None:
 				return False
 			else:
 				await self.refresh(store)
-		response = await http.get(url, headers=self.headers)
-		response.raise_if_error()
-		return response.body
+		# Only the headers come from the NEX session, the transfer goes through the download pool
+		return await downloads.get(url, self.headers)
 
 class ServerHeaders:
 	level_thumbnail = ServerDataTypeHeader(ServerDataTypes.level_thumbnail)
@@ -160,42 +147,279 @@ class ServerHeaders:
 	ninji_ghost_replay = ServerDataTypeHeader(ServerDataTypes.ninji_ghost_replay)
 	world_map_thumbnails = ServerDataTypeHeader(ServerDataTypes.world_map_thumbnails)
 
+# Image, crypto and compression work runs here instead of on the event loop
+if "cpu_executor" in args:
+	cpu = CPUExecutor(args["cpu_executor"].get("kind", "thread"), args["cpu_executor"].get("workers"),
+		args["cpu_executor"].get("max_queue", 64))
+else:
+	cpu = CPUExecutor()
+
+# Cache entries smaller than this are compressed and decompressed right away, handing them over costs more
+if "cpu_offload_bytes" in args:
+	cpu_offload_bytes = args["cpu_offload_bytes"]
+else:
+	cpu_offload_bytes = 65536
+
+# Thumbnails are JPEGs already, they are stored as they were sent instead of being encoded again
+if "thumbnail_passthrough" in args:
+	thumbnail_passthrough = args["thumbnail_passthrough"]
+else:
+	thumbnail_passthrough = True
+
+# Widths that can be asked for, each one is resized once and cached next to the original
+if "thumbnail_sizes" in args:
+	thumbnail_sizes = args["thumbnail_sizes"]
+else:
+	thumbnail_sizes = [64, 160, 320]
+
+thumbnail_stats = {"passthrough": 0, "reencoded": 0, "resized": 0}
+
+def is_jpeg(body):
+	# Start of image marker at the front and end of image marker at the back, ignoring zero padding
+	return body[:3] == b"\xff\xd8\xff" and body.rstrip(b"\0")[-2:] == b"\xff\xd9"
+
 async def download_thumbnail(store, url, filename, data_type, save = True):
 	if data_type == ServerDataTypes.level_thumbnail:
 		body = await ServerHeaders.level_thumbnail.request_url(url, store)
-		if body == False:
-			return False
-		else:
-			image = Image.open(io.BytesIO(body))
-			if save:
-				image.save(filename, optimize=True, quality=95)
-				return True
-			else:
-				image_bytes = io.BytesIO()
-				image.save(image_bytes, optimize=True, quality=95, format="jpeg")
-				return image_bytes.getvalue()
-
-	if data_type == ServerDataTypes.entire_level_thumbnail:
+	elif data_type == ServerDataTypes.entire_level_thumbnail:
 		body = await ServerHeaders.entire_level_thumbnail.request_url(url, store)
-		if body == False:
-			return False
+	else:
+		return False
+	if body == False:
+		return False
+
+	if thumbnail_passthrough and is_jpeg(body):
+		image = body
+		thumbnail_stats["passthrough"] += 1
+	else:
+		image = await cpu.run("thumbnail", reencode_jpeg, body)
+		thumbnail_stats["reencoded"] += 1
+	if save:
+		atomic_write(filename, image)
+		return True
+	else:
+		return image
+
+async def thumbnail_variant(path, size, refresh):
+	# path is the original thumbnail, size None uses it as is
+	if size is None:
+		return path
+
+	resized_path = "%s_%d.jpg" % (path[:-len(".jpg")], size)
+	if refresh or not pathlib.Path(resized_path).exists():
+		with open(path, "rb") as f:
+			body = f.read()
+		atomic_write(resized_path, await cpu.run("thumbnail_resize", resize_jpeg, body, size))
+		thumbnail_stats["resized"] += 1
+	return resized_path
+
+async def thumbnail_response(path, size, refresh):
+	return FileResponse(path=await thumbnail_variant(path, size, refresh), media_type="image/jpg")
+
+# Where each kind of thumbnail is cached, the course info field with its URL and the CDN headers it needs
+THUMBNAIL_TYPES = {
+	ServerDataTypes.level_thumbnail: ("cache/level_thumbnail", "one_screen_thumbnail", ServerHeaders.level_thumbnail),
+	ServerDataTypes.entire_level_thumbnail: ("cache/entire_level_thumbnail", "entire_thumbnail", ServerHeaders.entire_level_thumbnail)
+}
+
+async def obtain_thumbnail(course_id, data_type, noCaching = True):
+	# Returns the path of the thumbnail, whether it was just downloaded and the error JSON if there is no thumbnail
+	directory, url_field, headers = THUMBNAIL_TYPES[data_type]
+	path = "%s/%s.jpg" % (directory, course_id)
+	os.makedirs(directory, exist_ok=True)
+
+	if pathlib.Path(path).exists() and not noCaching:
+		return path, False, None
+
+	# Only the URL is needed from the course info, a cached course saves the course RPC
+	course_info_json = await cache_load("level_info", course_id)
+	if course_info_json is None or invalid_level(course_info_json):
+		# Merged with other course lookups and saved for the next thumbnail
+		course_info_json = await obtain_course_info(course_id, None, noCaching, True)
+		if invalid_level(course_info_json):
+			return None, False, course_info_json
+
+	if headers.expired():
+		# Requests made at the same time share one refresh
+		await coalesced(("thumbnail_headers", data_type), headers.refresh_if_needed)
+
+	# The download itself doesn't hold a session
+	if not await download_thumbnail(None, course_info_json[url_field]["url"], path, data_type):
+		return None, False, {"error": "Thumbnail cannot be downloaded", "course_id": course_id}
+	return path, True, None
+
+async def read_thumbnail(course_id, data_type, noCaching, size):
+	if invalid_thumbnail_size(size):
+		return ORJSONResponse(status_code=400, content={"error": "size must be one of %s" % ", ".join(str(size) for size in thumbnail_sizes)})
+
+	course_id = correct_course_id(course_id)
+	path, downloaded, error = await obtain_thumbnail(course_id, data_type, noCaching)
+	if error is not None:
+		return ORJSONResponse(status_code=400, content=error)
+	return await thumbnail_response(path, size, downloaded)
+
+def invalid_thumbnail_size(size):
+	return size is not None and size not in thumbnail_sizes
+
+if "cache_backend" in args:
+	cache = open_cache(args["cache_backend"], args.get("cache_path"))
+else:
+	cache = open_cache()
+
+cache_flush_task = None
+
+def schedule_cache_flush():
+	# Commits run in a thread, another worker holding the database can make them wait
+	global cache_flush_task
+	if cache_flush_task is None or cache_flush_task.done():
+		cache_flush_task = asyncio.create_task(flush_cache_in_thread())
+
+async def flush_cache_in_thread():
+	try:
+		await asyncio.get_running_loop().run_in_executor(None, cache.flush)
+	except Exception as e:
+		print("Writing the cache failed: %s" % e)
+
+async def flush_cache_periodically():
+	# Written entries reach the other workers within a second even when nothing else is saved
+	while True:
+		await asyncio.sleep(0.5)
+		if cache.flush_due():
+			schedule_cache_flush()
+
+if "hot_cache_mb" in args:
+	hot_cache = LRUCache(args["hot_cache_mb"] * 1024 * 1024)
+else:
+	hot_cache = LRUCache()
+
+def remember(namespace, key, content, blob, stored_at, value = None):
+	# Keep the serialized JSON and its compressed form together with the status code it is served with
+	if value is None:
+		value = orjson.loads(content)
+	if invalid_level(value):
+		entry = (content, stored_at, 400, blob)
+	else:
+		entry = (content, stored_at, 200, blob)
+	hot_cache.put((namespace, str(key)), entry, len(content) + len(blob))
+	return entry
+
+async def cache_lookup(namespace, key):
+	# Returns the serialized JSON, the time it was stored, its status code and the stored zlib blob
+	entry = hot_cache.get((namespace, str(key)))
+	if entry is None:
+		stored = cache.get_entry(namespace, key)
+		if stored is None:
+			return None
+		if len(stored[0]) > cpu_offload_bytes:
+			content = await cpu.run("cache_decompress", zlib.decompress, stored[0])
 		else:
-			image = Image.open(io.BytesIO(body))
-			if save:
-				image.save(filename, optimize=True, quality=95)
-				return True
-			else:
-				image_bytes = io.BytesIO()
-				image.save(image_bytes, optimize=True, quality=95, format="jpeg")
-				return image_bytes.getvalue()
+			content = zlib.decompress(stored[0])
+		entry = remember(namespace, key, content, stored[0], stored[1])
+	return entry
+
+async def cache_load(namespace, key):
+	entry = await cache_lookup(namespace, key)
+	if entry is None:
+		return None
+	return orjson.loads(entry[0])
+
+async def cache_save(namespace, key, value):
+	await cache_save_many(namespace, [(key, value)])
+
+async def cache_save_many(namespace, values):
+	stored_at = time.time()
+	contents = [orjson.dumps(value) for key, value in values]
+	if sum(len(content) for content in contents) > cpu_offload_bytes:
+		compressed = await cpu.run("cache_compress", compress_many, contents)
+	else:
+		compressed = compress_many(contents)
+
+	blobs = []
+	for (key, value), content, blob in zip(values, contents, compressed):
+		remember(namespace, key, content, blob, stored_at, value)
+		blobs.append((key, blob))
+	cache.put_many(namespace, blobs, stored_at)
+	if cache.flush_due():
+		schedule_cache_flush()
+
+# Seconds before a cached entry is refreshed, None never refreshes
+cache_ttl = {
+	"level_info": 3600,
+	"user_info": 3600,
+	"level_comments": 600,
+	"super_worlds": None,
+	"level_parsed": None
+}
+if "cache_ttl" in args:
+	cache_ttl.update(args["cache_ttl"])
+
+def is_stale(namespace, entry):
+	return cache_ttl[namespace] is not None and (time.time() - entry[1]) > cache_ttl[namespace]
+
+def accepted_encoding(request):
+	# Picks an encoding the stored zlib blob can be sent in without compressing it again
+	accepted = {}
+	for part in request.headers.get("accept-encoding", "").split(","):
+		params = part.strip().split(";")
+		quality = 1.0
+		for param in params[1:]:
+			name, _, value = param.strip().partition("=")
+			if name == "q":
+				try:
+					quality = float(value)
+				except ValueError:
+					quality = 0
+		accepted[params[0].strip().lower()] = quality
+	if accepted.get("deflate", 0) > 0:
+		return "deflate"
+	if accepted.get("gzip", 0) > 0:
+		return "gzip"
+	return None
+
+def zlib_to_gzip(blob, content):
+	# A zlib stream is a raw deflate stream between a 2 byte header and an adler32 trailer,
+	# gzip only needs a different header and the crc32 and length of the content
+	return b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff" + blob[2:-4] + pack("<II", zlib.crc32(content), len(content) & 0xFFFFFFFF)
+
+def cached_response(namespace, entry, request):
+	# The stored JSON is sent as is, without parsing and serializing it again
+	content, stored_at, status, blob = entry
+	headers = {"Age": str(int(time.time() - stored_at)), "Vary": "Accept-Encoding"}
+	if is_stale(namespace, entry):
+		headers["X-Cache"] = "STALE"
+	else:
+		headers["X-Cache"] = "HIT"
+
+	encoding = accepted_encoding(request)
+	if encoding == "deflate":
+		# HTTP deflate is the zlib format, so the stored blob is already a valid body
+		headers["Content-Encoding"] = "deflate"
+		content = blob
+	elif encoding == "gzip":
+		headers["Content-Encoding"] = "gzip"
+		content = zlib_to_gzip(blob, content)
+	return Response(content=content, status_code=status, media_type="application/json", headers=headers)
+
+refreshing = {}
+
+def revalidate(key, refresh):
+	# The stale entry has already been served, fetch a new one in the background
+	if key in refreshing:
+		return
+	async def run():
+		try:
+			await refresh()
+		except Exception as e:
+			print("Refreshing %s failed: %s" % (str(key), e))
+		finally:
+			del refreshing[key]
+	refreshing[key] = asyncio.create_task(run())
 
 def in_cache(course_id):
-	level_info_path = pathlib.Path("cache/level_info/%s" % course_id)
-	return level_info_path.exists()
+	return cache.contains("level_info", course_id)
 
 def in_user_cache(maker_id):
-	user_info_path = pathlib.Path("cache/user_info/%s" % maker_id)
-	return user_info_path.exists()
+	return cache.contains("user_info", maker_id)
 
 def invalid_level(course_info):
 	if "name" in course_info or "courses" in course_info or "comments" in course_info or "players" in course_info or "deaths" in course_info or "super_worlds" in course_info:
@@ -241,76 +465,17 @@ def is_maker_id(id):
 		return True
 	return False
 
-def get_mii_data(data):
-	# Based on https://github.com/HEYimHeroic/mii2studio/blob/master/mii2studio.py
-	user_mii = Gen3Switchgame.from_bytes(data)
-	mii_values = [
-		user_mii.facial_hair_color,
-		user_mii.facial_hair_beard,
-		user_mii.body_weight,
-		user_mii.eye_stretch,
-		user_mii.eye_color,
-		user_mii.eye_rotation,
-		user_mii.eye_size,
-		user_mii.eye_type,
-		user_mii.eye_horizontal,
-		user_mii.eye_vertical,
-		user_mii.eyebrow_stretch,
-		user_mii.eyebrow_color,
-		user_mii.eyebrow_rotation,
-		user_mii.eyebrow_size,
-		user_mii.eyebrow_type,
-		user_mii.eyebrow_horizontal,
-		user_mii.eyebrow_vertical,
-		user_mii.face_color,
-		user_mii.face_makeup,
-		user_mii.face_type,
-		user_mii.face_wrinkles,
-		user_mii.favorite_color,
-		user_mii.gender,
-		user_mii.glasses_color,
-		user_mii.glasses_size,
-		user_mii.glasses_type,
-		user_mii.glasses_vertical,
-		user_mii.hair_color,
-		user_mii.hair_flip,
-		user_mii.hair_type,
-		user_mii.body_height,
-		user_mii.mole_size,
-		user_mii.mole_enable,
-		user_mii.mole_horizontal,
-		user_mii.mole_vertical,
-		user_mii.mouth_stretch,
-		user_mii.mouth_color,
-		user_mii.mouth_size,
-		user_mii.mouth_type,
-		user_mii.mouth_vertical,
-		user_mii.facial_hair_size,
-		user_mii.facial_hair_mustache,
-		user_mii.facial_hair_vertical,
-		user_mii.nose_size,
-		user_mii.nose_type,
-		user_mii.nose_vertical
-	]
-
-	mii_data = b"00"
-	mii_bytes = ""
-	n = 256
-	for v in mii_values:
-		n = (7 + (v ^ n)) % 256
-		mii_data += hexlify(pack(">B", n))
-		mii_bytes += hexlify(pack(">B", v)).decode("ascii")
-
-	url = "https://studio.mii.nintendo.com/miis/image.png?data=" + mii_data.decode("utf-8")
-	return [url + "&type=face&width=512&instanceCount=1", mii_bytes]
-
-async def obtain_course_info(course_id, store, noCaching = True):
+async def obtain_course_info(course_id, store, noCaching = True, save = False, users = None):
 	param = datastore.GetUserOrCourseParam()
 	param.code = course_id
 	param.course_option = datastore.CourseOption.ALL
 
 	# Download a specific course
-	course_info_json = await get_course_info_json(CourseRequestType.course_id, param, store, noCaching)
+	course_info_json = await get_course_info_json(CourseRequestType.course_id, param, store, noCaching, save)
+
+	# Users are looked up after saving so they never end up in the course cache
+	if users is not None and not invalid_level(course_info_json):
+		await add_users_json([course_info_json], users, course_info_json)
 
 	return course_info_json
 
@@ -319,45 +484,102 @@ async def obtain_user_info(maker_id, store, noCaching = True, save = False):
 	param.code = maker_id
 	param.user_option = datastore.UserOption.ALL
 
-	loc = "cache/user_info/%s" % maker_id
+	if not noCaching:
+		user_info_json = await cache_load("user_info", maker_id)
+		if user_info_json is not None:
+			return user_info_json
+
+	if not is_maker_id(maker_id):
+		user_info_json = {"error": "Code corresponds to a level", "maker_id": maker_id}
+		await cache_save("user_info", maker_id, user_info_json)
+		return user_info_json
+
+	try:
+		response = await store.get_user_or_course(param)
+	except:
+		# Save (the empty) level info to json
+		print("maker_id " + maker_id + " is invalid")
+		user_info_json = {"error": "No user with that ID", "maker_id": maker_id}
+		await cache_save("user_info", maker_id, user_info_json)
+		return user_info_json
+
+	# The Mii is parsed on the CPU executor like in users_json
+	mii_info = None
+	if len(response.user.unk2) != 0:
+		mii_info = await cpu.run("mii", get_mii_data, response.user.unk2)
+
+	ret = {}
+	add_user_info_json(response.user, ret, mii_info)
 
-	# Prepare directories
-	os.makedirs(os.path.dirname(loc), exist_ok=True)
+	if save:
+		await cache_save("user_info", maker_id, ret)
+	return ret
 
-	user_info_path = pathlib.Path(loc)
-	if user_info_path.exists() and not noCaching:
-		with open(loc, mode="rb") as f:
-			return orjson.loads(zlib.decompress(f.read()))
-	else:
-		if not is_maker_id(maker_id):
-			with open(loc, mode="wb+") as f:
-				f.write(zlib.compress(('{"error": "Code corresponds to a level", "maker_id": "%s"}' % maker_id).encode("UTF8")))
-				return {"error": "Code corresponds to a level", "maker_id": maker_id}
-		else:
-			try:
-				response = await store.get_user_or_course(param)
-			except:
-				# Save (the empty) level info to json
-				print("maker_id " + maker_id + " is invalid")
-				with open(loc, mode="wb+") as f:
-					f.write(zlib.compress(('{"error": "No user with that ID", "maker_id": "%s"}' % maker_id).encode("UTF8")))
-					return {"error": "No user with that ID", "maker_id": maker_id}
-
-		ret = {}
-		add_user_info_json(response.user, ret)
-		
-		if save:
-			with open(loc, mode="wb+") as f:
-				f.write(zlib.compress(orjson.dumps(ret)))
-				return ret
-
-async def search_latest_courses(size, store):
+if "level_data_path" in args:
+	level_store = LevelStore(args["level_data_path"])
+else:
+	level_store = LevelStore()
+
+def load_level_data(data_id):
+	# The downloaded file, False if the level cannot be downloaded or None if it was never downloaded
+	row = level_store.lookup(data_id)
+	if row is None:
+		# Files downloaded before the level store existed are moved into it
+		loc = "cache/level_data_dataid/%s.bcd" % data_id
+		if pathlib.Path(loc).exists() and os.stat(loc).st_size != 0:
+			with open(loc, "rb") as f:
+				body = f.read()
+			level_store.put(data_id, body)
+			os.remove(loc)
+			return body
+		return None
+	if row[0] is None:
+		# Tried again on the next request
+		level_store.forget(data_id)
+		return False
+	return level_store.get(data_id)
+
+async def prepare_level_data(store, data_id):
+	param = datastore.DataStorePrepareGetParam()
+	param.data_id = data_id
+	try:
+		req_info = await store.prepare_get_object(param)
+	except:
+		# Remember that this level cannot be downloaded
+		level_store.mark_missing(data_id)
+		return None
+	return req_info.url
+
+async def obtain_level_data(data_id):
+	# The downloaded file, downloading it if needed, or None if the level cannot be downloaded
+	body = await cpu.run_thread("load_level_data", load_level_data, data_id)
+	if body is False:
+		return None
+	if body is not None:
+		return body
+
+	# Only the download link is requested on a NEX session, the file comes from the download pool
+	url = await coalesced(("level_data", data_id), lambda store: prepare_level_data(store, data_id), "bulk")
+	if url is None:
+		return None
+	return await inflight.do(("level_data_download", data_id), fetch_level_data, url, data_id)
+
+async def fetch_level_data(url, data_id):
+	body = await downloads.get(url)
+	try:
+		# Decrypting, hashing and compressing release the GIL, threads are enough
+		await cpu.run_thread("level_store_put", level_store.put, data_id, body)
+	except Exception as e:
+		print("Could not store level data for %d: %s" % (data_id, e))
+	return body
+
+async def search_latest_courses(size, store, offset = 0, save = False):
 	param = datastore.SearchCoursesLatestParam()
-	param.range.offset = 0
+	param.range.offset = offset
 	param.range.size = size
 	param.option = datastore.CourseOption.ALL
 
-	courses_info_json = await get_course_info_json(CourseRequestType.courses_latest, param, store)
+	courses_info_json = await get_course_info_json(CourseRequestType.courses_latest, param, store, save=save)
 
 	return courses_info_json
 
@@ -381,7 +603,7 @@ async def get_courses_posted(size, pid, store):
 
 	return courses_info_json
 
-def add_user_info_json(user, json_dict):
+def add_user_info_json(user, json_dict, mii_info = None):
 	json_dict["region"] = user.region
 	json_dict["code"] = user.code
 	json_dict["pid"] = str(user.pid)
@@ -390,7 +612,8 @@ def add_user_info_json(user, json_dict):
 	json_dict["last_active"] = user.last_active.timestamp()
 
 	if len(user.unk2) != 0:
-		mii_info = get_mii_data(user.unk2)
+		if mii_info is None:
+			mii_info = get_mii_data(user.unk2)
 		if debug_enabled:
 			json_dict["mii_data"] = user.unk2
 		else:
@@ -467,13 +690,64 @@ def add_user_info_json(user, json_dict):
 	json_dict["unk12"] = user.unk12
 	json_dict["unk16"] = user.unk16
 
+async def get_users_chunk(store, pids):
+	param = datastore.GetUsersParam()
+	param.pids = pids
+	param.option = datastore.UserOption.ALL
+	return (await store.get_users(param)).users
+
+async def fetch_users(pids):
+	# Duplicates are requested once and the 500 pid chunks are requested at the same time
+	unique_pids = list(dict.fromkeys(pid for pid in pids if pid != 0))
+	found = await fetch_chunked(unique_pids, get_users_chunk)
+	return await users_json(found)
+
+async def users_json(found):
+	# Invalid users have a pid of 0. The Miis of all users are read in one call on the CPU executor
+	found = [user for user in found if user.pid != 0]
+	miis = await cpu.run("mii", get_mii_data_many, [user.unk2 for user in found])
+
+	users = {}
+	for user, mii_info in zip(found, miis):
+		user_json = {}
+		add_user_info_json(user, user_json, mii_info)
+		users[str(user.pid)] = user_json
+	return users
+
+USER_PID_FIELDS = {
+	"uploader_pid": "uploader",
+	"first_completer_pid": "first_completer",
+	"record_holder_pid": "record_holder"
+}
+
+async def add_users_json(courses, mode, json_dict):
+	# "embed" puts the users in each course, "table" lists every user once in json_dict["users"] keyed by pid
+	pids = []
+	for course in courses:
+		for pid_field in USER_PID_FIELDS:
+			if pid_field in course:
+				pids.append(int(course[pid_field]))
+
+	users = await fetch_users(pids)
+
+	if mode == "table":
+		json_dict["users"] = users
+	else:
+		for course in courses:
+			for pid_field, user_field in USER_PID_FIELDS.items():
+				if pid_field in course and course[pid_field] in users:
+					course[user_field] = users[course[pid_field]]
+
+def invalid_users_mode(users):
+	return users is not None and users not in ("embed", "table")
+
 async def add_comment_info_json(store, course_id, course_info, noCaching = True, save = False):
-	loc = "cache/level_comments/%s" % course_id
 	comments_arr = []
 
-	if pathlib.Path(loc).exists() and not noCaching:
-		with open(loc, mode="rb") as f:
-			return orjson.loads(zlib.decompress(f.read()))
+	if not noCaching:
+		comments = await cache_load("level_comments", course_id)
+		if comments is not None:
+			return comments
 
 	user_pids = []
 	data_id = course_id_to_dataid(course_id)
@@ -540,17 +814,22 @@ async def add_comment_info_json(store, course_id, course_info, noCaching = True,
 	comments["comments"] = comments_arr
 
 	if save:
-		os.makedirs("cache/level_comments", exist_ok=True)
-		with open(loc, mode="wb+") as f:
-			f.write(zlib.compress(orjson.dumps(comments)))
+		await cache_save("level_comments", course_id, comments)
 	return comments
 
+async def fetch_level_comments(store, course_id, noCaching = True, save = False):
+	course_info_json = await obtain_course_info(course_id, store)
+	if invalid_level(course_info_json):
+		return course_info_json
+	return await add_comment_info_json(store, course_id, course_info_json, noCaching, save)
+
 async def search_world_map(store, ids, noCaching = True, save = False):
 	world_map_arr = []
 
-	if len(ids) == 1 and pathlib.Path("cache/super_worlds/%s" % ids[0]).exists() and not noCaching:
-		with open("cache/super_worlds/%s" % ids[0], mode="rb") as f:
-			return orjson.loads(zlib.decompress(f.read()))
+	if len(ids) == 1 and not noCaching:
+		world_map_json = await cache_load("super_worlds", ids[0])
+		if world_map_json is not None:
+			return world_map_json
 
 	param = datastore.GetWorldMapParam()
 	param.ids = ids
@@ -590,10 +869,7 @@ async def search_world_map(store, ids, noCaching = True, save = False):
 		i += 1
 
 	if save:
-		os.makedirs("cache/super_worlds", exist_ok=True)
-		for map in world_map_arr:
-			with open("cache/super_worlds/%s" % map["id"], mode="wb+") as f:
-				f.write(zlib.compress(orjson.dumps(map)))
+		await cache_save_many("super_worlds", [(map["id"], map) for map in world_map_arr])
 
 	world_map_json = {}
 	world_map_json["super_worlds"] = world_map_arr
@@ -605,46 +881,52 @@ async def get_course_info_json(request_type, request_param, store, noCaching = T
 	stop_on_bad = True
 
 	if request_type == CourseRequestType.course_id:
-		loc = "cache/level_info/%s" % request_param.code
+		course_info = None
+		if not noCaching:
+			course_info = await cache_load("level_info", request_param.code)
 
-		# Prepare directories
-		os.makedirs(os.path.dirname(loc), exist_ok=True)
-
-		level_info_path = pathlib.Path(loc)
-		if level_info_path.exists() and not noCaching:
-			with open(loc, mode="rb") as f:
-				courses.append(orjson.loads(zlib.decompress(f.read())))
-				from_cache.append(True)
+		if course_info is not None:
+			courses.append(course_info)
+			from_cache.append(True)
 		else:
 			if invalid_course_id_length(request_param.code):
 				# Save (the empty) level info to json
 				print("course_id " + request_param.code + " is wrong length")
-				with open(loc, mode="wb+") as f:
-					f.write(zlib.compress(('{"error": "Invalid course ID", "course_id": "%s"}' % request_param.code).encode("UTF8")))
-					return {"error": "Invalid course ID", "course_id": request_param.code}
+				course_info = {"error": "Invalid course ID", "course_id": request_param.code}
+				await cache_save("level_info", request_param.code, course_info)
+				return course_info
 
 			if is_maker_id(request_param.code):
 				print("course_id " + request_param.code + " is actually maker_id")
-				with open(loc, mode="wb+") as f:
-					f.write(zlib.compress(('{"error": "Code corresponds to a maker", "course_id": "%s"}' % request_param.code).encode("UTF8")))
-					return {"error": "Code corresponds to a maker", "course_id": request_param.code}
+				course_info = {"error": "Code corresponds to a maker", "course_id": request_param.code}
+				await cache_save("level_info", request_param.code, course_info)
+				return course_info
 
-			try:
-				response = await store.get_user_or_course(request_param)
-				if response.user.pid != 0:
-					print("course_id " + request_param.code + " is invalid")
-					with open(loc, mode="wb+") as f:
-						f.write(zlib.compress(('{"error": "No course with that ID", "course_id": "%s"}' % request_param.code).encode("UTF8")))
-						return {"error": "No course with that ID", "course_id": request_param.code}
-			except Exception as e:
-				print(e)
+			if store:
+				try:
+					response = await store.get_user_or_course(request_param)
+					course = response.course
+					if response.user.pid != 0:
+						course = None
+				except Exception as e:
+					print(e)
+					course = None
+			else:
+				# Merged with other lookups into one get_courses call, unknown codes come back without an owner.
+				# Looking up by data_id ignores the check bits of the code, so a mistyped code can land on
+				# another course, only the course with exactly this code counts
+				course = await course_batcher.get(request_param.code)
+				if course.owner_id == 0 or course.code != request_param.code:
+					course = None
+
+			if course is None:
 				# Save (the empty) level info to json
 				print("course_id " + request_param.code + " is invalid")
-				with open(loc, mode="wb+") as f:
-					f.write(zlib.compress(('{"error": "No course with that ID", "course_id": "%s"}' % request_param.code).encode("UTF8")))
-					return {"error": "No course with that ID", "course_id": request_param.code}
+				course_info = {"error": "No course with that ID", "course_id": request_param.code}
+				await cache_save("level_info", request_param.code, course_info)
+				return course_info
 
-			courses.append(response.course)
+			courses.append(course)
 			from_cache.append(False)
 
 	if request_type == CourseRequestType.courses_endless_mode:
@@ -779,7 +1061,7 @@ async def get_course_info_json(request_type, request_param, store, noCaching = T
 			course_info["unk11"] = course.unk11
 			course_info["unk12"] = course.unk12
 
-			if pathlib.Path("cache/level_info/%s" % course.code).exists():
+			if in_cache(course.code):
 				cache_hits += 1
 
 			uploader_pids.append(course.owner_id)
@@ -791,48 +1073,35 @@ async def get_course_info_json(request_type, request_param, store, noCaching = T
 
 	del course_info_json["courses"][i:]
 
-	if store:
-		all_pids = uploader_pids + first_clear_pids + record_holder_pids
-		all_pids_split = [all_pids[i:i+500] for i in range(len(all_pids))[::500]]
-		all_pids_result = []
-		if not debug_enabled:
-			for pids_chunk in all_pids_split:
-				param = datastore.GetUsersParam()
-				param.pids = pids_chunk
-				param.option = datastore.UserOption.ALL
-
-				all_pids_result += (await store.get_users(param)).users
-		if len(uploader_pids) != 0:
-			i = 0
-			for user_pid in uploader_pids:
-				if user_pid != 0:
-					course_info_json["courses"][i]["uploader_pid"] = str(user_pid)
-				i += 1
-
-		if len(first_clear_pids) != 0:
-			i = 0
-			for user_pid in first_clear_pids:
-				if user_pid != 0:
-					course_info_json["courses"][i]["first_completer_pid"] = str(user_pid)
-				i += 1
+	if len(uploader_pids) != 0:
+		i = 0
+		for user_pid in uploader_pids:
+			if user_pid != 0:
+				course_info_json["courses"][i]["uploader_pid"] = str(user_pid)
+			i += 1
 
-		if len(record_holder_pids) != 0:
-			i = 0
-			for user_pid in record_holder_pids:
-				if user_pid != 0:
-					course_info_json["courses"][i]["record_holder_pid"] = str(user_pid)
-				i += 1
+	if len(first_clear_pids) != 0:
+		i = 0
+		for user_pid in first_clear_pids:
+			if user_pid != 0:
+				course_info_json["courses"][i]["first_completer_pid"] = str(user_pid)
+			i += 1
 
-		if save:
-			i = 0
-			os.makedirs("cache/level_info", exist_ok=True)
-			for course in course_info_json["courses"]:
-				if not from_cache[i]:
-					loc = "cache/level_info/%s" % course["course_id"]
-					with open(loc, mode="wb+") as f:
-						f.write(zlib.compress(orjson.dumps(course)))
+	if len(record_holder_pids) != 0:
+		i = 0
+		for user_pid in record_holder_pids:
+			if user_pid != 0:
+				course_info_json["courses"][i]["record_holder_pid"] = str(user_pid)
+			i += 1
 
-				i += 1
+	if save:
+		i = 0
+		new_courses = []
+		for course in course_info_json["courses"]:
+			if not from_cache[i]:
+				new_courses.append((course["course_id"], course))
+			i += 1
+		await cache_save_many("level_info", new_courses)
 
 	if request_type == CourseRequestType.course_id:
 		return course_info_json["courses"][0]
@@ -842,136 +1111,383 @@ async def get_course_info_json(request_type, request_param, store, noCaching = T
 
 HOST = "g%08x-lp1.s.n.srv.nintendo.net" % SMM2_GAME_SERVER_ID
 PORT = 443
-s = None
-user_id = None
-auth_info = None
-device_token_generated_time = None
-id_token_generated_time = None
-device_token = None
-app_token = None
-access_token = None
-id_token = None
-getting_credentials = asyncio.Lock()
 
 def milliseconds_since_epoch():
 	return time.time_ns() // 1000000
 
+async def generate_device_tokens(identity):
+	cert = identity.info.get_tls_cert()
+	pkey = identity.info.get_tls_key()
+
+	print("Generate device token")
+	dauth = DAuthClient(identity.keys)
+	dauth.set_certificate(cert, pkey)
+	dauth.set_system_version(identity.system_version)
+	response = await dauth.device_token(dauth.BAAS)
+	device_token = response["device_auth_token"]
+	print("Generated device token")
+
+	print("Generate contents token")
+	dragons = DragonsClient()
+	dragons.set_certificate(cert, pkey)
+	dragons.set_system_version(identity.system_version)
+	response = await dauth.device_token(dauth.DRAGONS)
+	device_token_dragons = response["device_auth_token"]
+	response = await dragons.contents_authorization_token_for_aauth(device_token_dragons, identity.elicense_id, identity.na_id, SMM2_TITLE_ID)
+	contents_token = response["contents_authorization_token"]
+	print("Generated contents token")
+
+	print("Generate app token")
+	aauth = AAuthClient()
+	aauth.set_system_version(identity.system_version)
+	response = await aauth.auth_digital(
+		SMM2_TITLE_ID, SMM2_LATEST_VERSION,
+		device_token, contents_token
+	)
+	app_token = response["application_auth_token"]
+	print("Generated app token")
+
+	return {"device_token": device_token, "app_token": app_token}
+
+async def generate_id_token(identity, tokens):
+	baas = BAASClient()
+	baas.set_system_version(identity.system_version)
+	response = await baas.authenticate(tokens["device_token"])
+	access_token = response["accessToken"]
+	response = await baas.login(identity.baas_user_id, identity.baas_password, access_token, tokens["app_token"])
+	id_token = response["idToken"]
+	user_id = str(int(response["user"]["id"], 16))
+	print("Generated id token")
+
+	return {"access_token": access_token, "id_token": id_token, "user_id": user_id}
+
+def prepare_login(tokens):
+	auth_info = authentication.AuthenticationInfo()
+	auth_info.token = tokens["id_token"]
+	auth_info.ngs_version = 4
+	auth_info.token_type = 2
+
+	print("Loading settings")
+	s = settings.load("switch")
+	s.configure(SMM2_ACCESS_KEY, SMM2_NEX_VERSION, SMM2_CLIENT_VERSION)
+	print("Loaded settings")
+
+	return {"auth_info": auth_info, "settings": s}
+
 async def check_tokens():
-	global HOST
-	global PORT
-	global s
-	global user_id
-	global auth_info
-	global device_token_generated_time
-	global id_token_generated_time
-	global device_token
-	global app_token
-	global access_token
-	global id_token
-	global getting_credentials
-	if getting_credentials.locked():
-		# Another thread is busy refreshing the credentials, wait until it is done and return
-		async with getting_credentials:
-			return
-	# Either has never been generated or is older than 23.9 hours
-	if device_token_generated_time is None or (milliseconds_since_epoch() - device_token_generated_time) > 85340000:
-		async with getting_credentials:
-			cert = info.get_tls_cert()
-			pkey = info.get_tls_key()
-
-			print("Generate device token")
-			dauth = DAuthClient(keys)
-			dauth.set_certificate(cert, pkey)
-			dauth.set_system_version(SYSTEM_VERSION)
-			response = await dauth.device_token(dauth.BAAS)
-			device_token = response["device_auth_token"]
-			print("Generated device token")
-
-			print("Generate contents token")
-			dragons = DragonsClient()
-			dragons.set_certificate(cert, pkey)
-			dragons.set_system_version(SYSTEM_VERSION)
-			response = await dauth.device_token(dauth.DRAGONS)
-			device_token_dragons = response["device_auth_token"]
-			response = await dragons.contents_authorization_token_for_aauth(device_token_dragons, ELICENSE_ID, NA_ID, SMM2_TITLE_ID)
-			contents_token = response["contents_authorization_token"]
-			print("Generated contents token")
-
-			print("Generate app token")
-			aauth = AAuthClient()
-			aauth.set_system_version(SYSTEM_VERSION)
-			response = await aauth.auth_digital(
-				SMM2_TITLE_ID, SMM2_LATEST_VERSION,
-				device_token, contents_token
-			)
-			app_token = response["application_auth_token"]
-			print("Generated app token")
-
-			device_token_generated_time = milliseconds_since_epoch()
-
-			id_token = None
-			print("Generate id token")
-			baas = BAASClient()
-			baas.set_system_version(SYSTEM_VERSION)
-			response = await baas.authenticate(device_token)
-			access_token = response["accessToken"]
-			response = await baas.login(BAAS_USER_ID, BAAS_PASSWORD, access_token, app_token)
-			id_token = response["idToken"]
-			user_id = str(int(response["user"]["id"], 16))
-			print("Generated id token")
-
-			id_token_generated_time = milliseconds_since_epoch()
-
-			auth_info = authentication.AuthenticationInfo()
-			auth_info.token = id_token
-			auth_info.ngs_version = 4
-			auth_info.token_type = 2
-
-			print("Loading settings")
-			s = settings.load("switch")
-			s.configure(SMM2_ACCESS_KEY, SMM2_NEX_VERSION, SMM2_CLIENT_VERSION)
-			print("Loaded settings")
-	# Either has never been generated or is older than 2.9 hours
-	if id_token_generated_time is None or (milliseconds_since_epoch() - id_token_generated_time) > 1044000:
-		async with getting_credentials:
-			print("Generate id token")
-			baas = BAASClient()
-			baas.set_system_version(SYSTEM_VERSION)
-			response = await baas.authenticate(device_token)
-			access_token = response["accessToken"]
-			response = await baas.login(BAAS_USER_ID, BAAS_PASSWORD, access_token, app_token)
-			id_token = response["idToken"]
-			user_id = str(int(response["user"]["id"], 16))
-			print("Generated id token")
-
-			id_token_generated_time = milliseconds_since_epoch()
-
-			auth_info = authentication.AuthenticationInfo()
-			auth_info.token = id_token
-			auth_info.ngs_version = 4
-			auth_info.token_type = 2
-
-			print("Loading settings")
-			s = settings.load("switch")
-			s.configure(SMM2_ACCESS_KEY, SMM2_NEX_VERSION, SMM2_CLIENT_VERSION)
-			print("Loaded settings")
-			print("Ready to go!")
-
-async def main():
-	print("Running API setup")
+	# Only waits if the server has not logged in with any identity yet
+	await session_pool.ready()
+
+@contextlib.asynccontextmanager
+async def open_store(identity):
+	tokens = await identity.credentials.get()
+	async with backend.connect(tokens["settings"], HOST, PORT) as be:
+		async with be.login(tokens["user_id"], auth_info=tokens["auth_info"]) as client:
+			yield TimedStore(datastore.DataStoreClientSMM2(client))
+
+async def check_store(store):
+	# Cheap RPC that also keeps the thumbnail headers fresh
+	await ServerHeaders.level_thumbnail.refresh(store)
+
+if "download_pool_size" in args:
+	downloads = DownloadPool(args["download_pool_size"])
+else:
+	downloads = DownloadPool()
+
+if "session_pool_size" in args:
+	session_pool_size = args["session_pool_size"]
+else:
+	session_pool_size = 3
+if "session_streams" in args:
+	session_streams = args["session_streams"]
+else:
+	session_streams = 4
+
+if "token_store" in args:
+	token_store_path = args["token_store"]
+else:
+	token_store_path = "tokens"
+
+# The device token lasts 23.9 hours and the id token is renewed after 17.4 minutes,
+# both are generated in the background ahead of time and sessions with old tokens are replaced.
+# Tokens are kept in token_store_path so every worker and restart uses the same ones
+def setup_identity(identity):
+	identity.credentials = CredentialManager(
+		lambda: generate_device_tokens(identity),
+		lambda tokens: generate_id_token(identity, tokens),
+		prepare=prepare_login,
+		token_store=TokenStore(os.path.join(token_store_path, "%s.json" % identity.name)),
+		on_refresh=lambda: identity.pool.invalidate()
+	)
+	identity.pool = SessionPool(lambda: open_store(identity), size=session_pool_size, streams=session_streams, health_check=check_store)
+
+for identity in identity_list:
+	setup_identity(identity)
+# Requests go to the least loaded identity that is logged in and not failing
+session_pool = ShardedSessionPool(identity_list)
+
+# Limits how many calls are made to Nintendo's servers at once, tuned from how fast they respond
+if "upstream_limit" in args:
+	upstream_limit = args["upstream_limit"]
+else:
+	upstream_limit = {}
+limiter = AdaptiveLimiter(
+	initial=upstream_limit.get("initial", 3),
+	min_limit=upstream_limit.get("min", 1),
+	max_limit=upstream_limit.get("max", len(identity_list) * session_pool_size * session_streams),
+	bulk_share=upstream_limit.get("bulk_share", 0.5)
+)
+inflight = SingleFlight()
+
+async def fetch_courses_batch(course_ids):
+	param = datastore.GetCoursesParam()
+	param.data_ids = [course_id_to_dataid(course_id) for course_id in course_ids]
+	param.option = datastore.CourseOption.ALL
 	await check_tokens()
+	async with limiter.slot():
+		async with session_pool.session() as store:
+			return (await store.get_courses(param)).courses
+
+async def fetch_users_batch(pids):
+	param = datastore.GetUsersParam()
+	param.pids = pids
+	param.option = datastore.UserOption.ALL
+	await check_tokens()
+	async with limiter.slot():
+		async with session_pool.session() as store:
+			return (await store.get_users(param)).users
 
-class AsyncLoopThread(Thread):
-	def __init__(self):
-		super().__init__(daemon=True)
-		self.loop = asyncio.new_event_loop()
+if "batch_window_ms" in args:
+	batch_window = args["batch_window_ms"] / 1000
+else:
+	batch_window = 0.01
+course_batcher = MicroBatcher(fetch_courses_batch, window=batch_window)
+user_batcher = MicroBatcher(fetch_users_batch, window=batch_window)
 
-	def run(self):
-		asyncio.set_event_loop(self.loop)
-		self.loop.run_forever()
+if "bulk_fan_out" in args:
+	bulk_fan_out = args["bulk_fan_out"]
+else:
+	bulk_fan_out = 3
+
+if "bulk_max_ids" in args:
+	bulk_max_ids = args["bulk_max_ids"]
+else:
+	bulk_max_ids = 1500
+
+async def fetch_chunked(items, fetch_chunk, chunk_size = 500):
+	# Every chunk gets its own pooled session so they are requested in parallel,
+	# at most bulk_fan_out at a time so one bulk request cannot take the whole pool.
+	# Must not be called while holding a session, the chunks wait for free ones
+	if len(items) == 0:
+		return []
+	await check_tokens()
+	fan_out = asyncio.Semaphore(bulk_fan_out)
+	async def run(chunk):
+		async with fan_out:
+			async with limiter.slot("bulk"):
+				async with session_pool.session() as store:
+					return await fetch_chunk(store, chunk)
+	chunks = await asyncio.gather(*[run(items[i:i+chunk_size]) for i in range(0, len(items), chunk_size)])
+	return [result for chunk in chunks for result in chunk]
+
+async def export_courses(batches):
+	# batches yields the data_ids of each batch with the cursors to resume from before and after it.
+	# Up to bulk_fan_out batches are fetched ahead while earlier ones are sent,
+	# so memory does not grow with the size of the export
+	async def fetch(data_ids):
+		async with limiter.slot("bulk"):
+			async with session_pool.session() as store:
+				return await get_courses_data_id(data_ids, store)
+
+	await check_tokens()
+	pending = collections.deque()
+	try:
+		while True:
+			while len(pending) < bulk_fan_out:
+				batch = next(batches, None)
+				if batch is None:
+					break
+				data_ids, start_cursor, end_cursor = batch
+				pending.append((asyncio.create_task(fetch(data_ids)), start_cursor, end_cursor))
+			if len(pending) == 0:
+				return
+
+			task, start_cursor, end_cursor = pending.popleft()
+			try:
+				courses_info_json = await task
+			except Exception as e:
+				# The client can resume from the start of the failed batch
+				yield orjson.dumps({"error": str(e), "cursor": start_cursor}) + b"\n"
+				return
+			lines = [orjson.dumps(course_info) for course_info in courses_info_json["courses"]]
+			lines.append(orjson.dumps({"cursor": end_cursor}))
+			yield b"\n".join(lines) + b"\n"
+	finally:
+		# The client went away or a batch failed, don't keep fetching for nobody
+		for task, _, _ in pending:
+			task.cancel()
+
+async def fetch_latest_courses(offset, size):
+	await check_tokens()
+	async with limiter.slot("bulk"):
+		async with session_pool.session() as store:
+			# New courses go straight into the cache
+			return (await search_latest_courses(size, store, offset, True))["courses"]
+
+if "follow_latest_interval" in args:
+	follow_latest_interval = args["follow_latest_interval"]
+else:
+	follow_latest_interval = 10
+# Every uvicorn worker serves the feed but only one of them polls Nintendo's servers for it
+follower = CourseFollower(fetch_latest_courses, interval=follow_latest_interval,
+	shared_path=os.path.join(token_store_path, "follower.json"))
+
+async def course_events(data_id):
+	while True:
+		courses = await follower.wait(data_id, 15)
+		if len(courses) == 0:
+			# Keeps proxies from closing the connection
+			yield b": keep-alive\n\n"
+			continue
+		for course_info in courses:
+			yield b"id: %d\nevent: course\ndata: %s\n\n" % (course_info["data_id"], orjson.dumps(course_info))
+		data_id = courses[-1]["data_id"]
+
+if "bulk_download_concurrency" in args:
+	bulk_download_concurrency = args["bulk_download_concurrency"]
+else:
+	bulk_download_concurrency = 8
+
+def tar_member(name, data):
+	info = tarfile.TarInfo(name)
+	info.size = len(data)
+	info.mtime = int(time.time())
+	info.mode = 0o644
+	# Members are padded to 512 byte blocks
+	return info.tobuf(format=tarfile.USTAR_FORMAT) + data + b"\0" * (-len(data) % 512)
+
+async def level_data_archive(data_ids):
+	# Streams a tar of the .bcd files in the order they finish. The prepare calls run on pooled
+	# sessions and the downloads from Nintendo's CDN bulk_download_concurrency at a time,
+	# so the next levels are being prepared while others download
+	download_slots = asyncio.Semaphore(bulk_download_concurrency)
+
+	async def get(data_id):
+		try:
+			body = await cpu.run_thread("load_level_data", load_level_data, data_id)
+			if body is False:
+				return data_id, None, "Level data file cannot be downloaded"
+			if body is not None:
+				return data_id, body, None
+
+			async with limiter.slot("bulk"):
+				async with session_pool.session() as store:
+					url = await prepare_level_data(store, data_id)
+			if url is None:
+				return data_id, None, "Level data file cannot be downloaded"
+
+			async with download_slots:
+				return data_id, await fetch_level_data(url, data_id), None
+		except Exception as e:
+			return data_id, None, str(e)
+
+	await check_tokens()
+	remaining = iter(data_ids)
+	pending = set()
+	missing = []
+	try:
+		while True:
+			# Enough in flight to keep every download slot busy, without reading the whole list ahead
+			while len(pending) < bulk_download_concurrency * 2:
+				data_id = next(remaining, None)
+				if data_id is None:
+					break
+				pending.add(asyncio.create_task(get(data_id)))
+			if len(pending) == 0:
+				break
+
+			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				data_id, body, error = task.result()
+				if body is None:
+					missing.append({"data_id": data_id, "error": error})
+				else:
+					yield tar_member("%d.bcd" % data_id, body)
+
+		if len(missing) != 0:
+			yield tar_member("missing.json", orjson.dumps(missing))
+		# End of archive
+		yield b"\0" * 1024
+	finally:
+		for task in pending:
+			task.cancel()
+
+async def thumbnail_archive(course_ids, data_type, noCaching, size):
+	# Streams a tar of the thumbnails in the order they finish, bulk_download_concurrency at a time
+	download_slots = asyncio.Semaphore(bulk_download_concurrency)
+
+	async def get(course_id):
+		try:
+			async with download_slots:
+				path, downloaded, error = await obtain_thumbnail(course_id, data_type, noCaching)
+				if error is not None:
+					return course_id, None, error.get("error")
+				with open(await thumbnail_variant(path, size, downloaded), "rb") as f:
+					return course_id, f.read(), None
+		except Exception as e:
+			return course_id, None, str(e)
+
+	remaining = iter(course_ids)
+	pending = set()
+	missing = []
+	try:
+		while True:
+			while len(pending) < bulk_download_concurrency * 2:
+				course_id = next(remaining, None)
+				if course_id is None:
+					break
+				pending.add(asyncio.create_task(get(course_id)))
+			if len(pending) == 0:
+				break
+
+			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				course_id, body, error = task.result()
+				if body is None:
+					missing.append({"course_id": course_id, "error": error})
+				else:
+					yield tar_member("%s.jpg" % course_id, body)
+
+		if len(missing) != 0:
+			yield tar_member("missing.json", orjson.dumps(missing))
+		# End of archive
+		yield b"\0" * 1024
+	finally:
+		for task in pending:
+			task.cancel()
+
+def data_id_range_batches(start, end):
+	# Cursors are the next data_id to fetch, None once the range is done
+	for batch_start in range(start, end + 1, 500):
+		batch_end = min(batch_start + 500, end + 1)
+		yield list(range(batch_start, batch_end)), batch_start, batch_end if batch_end <= end else None
+
+def data_id_list_batches(data_ids, offset):
+	# Cursors are the position in the uploaded list
+	for batch_start in range(offset, len(data_ids), 500):
+		batch_end = min(batch_start + 500, len(data_ids))
+		yield data_ids[batch_start:batch_end], batch_start, batch_end if batch_end < len(data_ids) else None
+
+async def coalesced(key, fetch, priority = "interactive"):
+	# Identical requests made while one is running share its upstream fetch
+	async def run():
+		await check_tokens()
+		async with limiter.slot(priority):
+			async with session_pool.session() as store:
+				return await fetch(store)
+	return await inflight.do(key, run)
 
 app = FastAPI(openapi_url=None)
-lock = asyncio.Semaphore(3)
 
 app.add_middleware(
 	CORSMiddleware,
@@ -993,75 +1509,134 @@ async def add_process_time_header(request, call_next):
 
 print("Start FastAPI")
 
+@app.on_event("startup")
+async def start_credentials():
+	print("Running API setup")
+	for identity in identity_list:
+		identity.credentials.start()
+	if follow_latest_interval:
+		follower.start()
+	asyncio.create_task(flush_cache_periodically())
+
+@app.on_event("shutdown")
+async def flush_cache():
+	if cache_flush_task is not None:
+		await cache_flush_task
+	# Whatever is still pending is written before exiting
+	cache.close()
+	level_store.close()
+	cpu.close()
+
+@app.get("/metrics")
+async def read_metrics():
+	return ORJSONResponse(content={
+		"identities": session_pool.metrics(),
+		"limiter": limiter.metrics(),
+		"follower": follower.metrics(),
+		"downloads": downloads.metrics(),
+		"level_store": level_store.metrics(),
+		"cpu": cpu.metrics(),
+		"thumbnails": thumbnail_stats,
+		"inflight": inflight.metrics(),
+		"course_batcher": course_batcher.metrics(),
+		"user_batcher": user_batcher.metrics(),
+		"hot_cache": hot_cache.metrics()
+	})
+
 @app.get("/level_info/{course_id}")
-async def read_level_info(course_id: str, noCaching: bool = True):
+async def read_level_info(request: Request, course_id: str, noCaching: bool = True, users: str = None):
+	if invalid_users_mode(users):
+		return ORJSONResponse(status_code=400, content={"error": "users must be embed or table"})
+
 	course_id = correct_course_id(course_id)
-	if (in_cache(course_id) or invalid_course_id_length(course_id) or is_maker_id(course_id)) and not noCaching:
-		course_info_json = await obtain_course_info(course_id, None)
+	if not noCaching:
+		entry = await cache_lookup("level_info", course_id)
+		if entry is not None:
+			if is_stale("level_info", entry):
+				revalidate(("level_info", course_id), lambda: obtain_course_info(course_id, None, True, True))
+			if users is None or entry[2] != 200:
+				return cached_response("level_info", entry, request)
+
+			course_info_json = orjson.loads(entry[0])
+			await add_users_json([course_info_json], users, course_info_json)
+			return ORJSONResponse(content=course_info_json)
+
+	if (invalid_course_id_length(course_id) or is_maker_id(course_id)) and not noCaching:
+		course_info_json = await obtain_course_info(course_id, None, False, users=users)
 
 		if invalid_level(course_info_json):
 			return ORJSONResponse(status_code=400, content=course_info_json)
 
 		return ORJSONResponse(content=course_info_json)
 	else:
-		await check_tokens()
-		async with lock:
-			async with backend.connect(s, HOST, PORT) as be:
-				async with be.login(str(user_id), auth_info=auth_info) as client:
-					store = datastore.DataStoreClientSMM2(client)
-					print("Want course info for " + course_id)
-					course_info_json = await obtain_course_info(course_id, store, noCaching)
+		print("Want course info for " + course_id)
+		# Without a store the course is fetched through the batcher, misses are saved when caching is allowed
+		course_info_json = await inflight.do(("level_info", course_id, noCaching, users),
+			obtain_course_info, course_id, None, noCaching, not noCaching, users)
 
-					if invalid_level(course_info_json):
-						return ORJSONResponse(status_code=400, content=course_info_json)
+		if invalid_level(course_info_json):
+			return ORJSONResponse(status_code=400, content=course_info_json)
 
-					return ORJSONResponse(content=course_info_json)
+		return ORJSONResponse(content=course_info_json)
 
 @app.get("/user_info/{maker_id}")
-async def read_user_info(maker_id: str, noCaching: bool = True):
+async def read_user_info(request: Request, maker_id: str, noCaching: bool = True):
 	maker_id = correct_course_id(maker_id)
-	if (in_user_cache(maker_id) or invalid_course_id_length(maker_id) or not is_maker_id(maker_id)) and not noCaching:
-		user_info_json = await obtain_user_info(maker_id, None)
+	if not noCaching:
+		entry = await cache_lookup("user_info", maker_id)
+		if entry is not None:
+			if is_stale("user_info", entry):
+				revalidate(("user_info", maker_id), lambda: coalesced(("user_info", maker_id, "refresh"),
+					lambda store: obtain_user_info(maker_id, store, True, True)))
+			return cached_response("user_info", entry, request)
+
+	if (invalid_course_id_length(maker_id) or not is_maker_id(maker_id)) and not noCaching:
+		user_info_json = await obtain_user_info(maker_id, None, False)
 
 		if invalid_level(user_info_json):
 			return ORJSONResponse(status_code=400, content=user_info_json)
 
 		return ORJSONResponse(content=user_info_json)
 	else:
-		await check_tokens()
-		async with lock:
-			async with backend.connect(s, HOST, PORT) as be:
-				async with be.login(str(user_id), auth_info=auth_info) as client:
-					store = datastore.DataStoreClientSMM2(client)
-					print("Want user info for " + maker_id)
-					user_info_json = await obtain_user_info(maker_id, store, noCaching)
+		print("Want user info for " + maker_id)
+		user_info_json = await coalesced(("user_info", maker_id, noCaching),
+			lambda store: obtain_user_info(maker_id, store, noCaching, not noCaching))
 
-					if invalid_level(user_info_json):
-						return ORJSONResponse(status_code=400, content=user_info_json)
+		if invalid_level(user_info_json):
+			return ORJSONResponse(status_code=400, content=user_info_json)
 
-					return ORJSONResponse(content=user_info_json)
+		return ORJSONResponse(content=user_info_json)
 
 @app.get("/level_info_multiple/{data_ids}")
-async def read_level_infos(data_ids: str):
+async def read_level_infos(data_ids: str, users: str = None):
+	if invalid_users_mode(users):
+		return ORJSONResponse(status_code=400, content={"error": "users must be embed or table"})
+
 	corrected_data_ids = []
 	for id in data_ids.split(","):
 		corrected_data_ids.append(int(id))
 
-	if len(corrected_data_ids) > 500:
-		return ORJSONResponse(status_code=400, content={"error": "Number of courses requested must be between 1 and 500"})
+	if len(corrected_data_ids) > bulk_max_ids:
+		return ORJSONResponse(status_code=400, content={"error": "Number of courses requested must be between 1 and %d" % bulk_max_ids})
 
-	await check_tokens()
-	async with lock:
-		async with backend.connect(s, HOST, PORT) as be:
-			async with be.login(str(user_id), auth_info=auth_info) as client:
-				store = datastore.DataStoreClientSMM2(client)
-				print("Want course infos for " + data_ids)
-				course_info_json = await get_courses_data_id(corrected_data_ids, store)
+	print("Want course infos for " + data_ids)
+	async def get_courses_chunk(store, data_ids_chunk):
+		return [await get_courses_data_id(data_ids_chunk, store)]
+	chunks = await fetch_chunked(corrected_data_ids, get_courses_chunk)
+
+	for chunk in chunks:
+		if invalid_level(chunk):
+			return ORJSONResponse(status_code=400, content=chunk)
+
+	course_info_json = {"courses": [], "cache_hits": 0}
+	for chunk in chunks:
+		course_info_json["courses"] += chunk["courses"]
+		course_info_json["cache_hits"] += chunk["cache_hits"]
 
-				if invalid_level(course_info_json):
-					return ORJSONResponse(status_code=400, content=course_info_json)
+	if users is not None:
+		await add_users_json(course_info_json["courses"], users, course_info_json)
 
-				return ORJSONResponse(content=course_info_json)
+	return ORJSONResponse(content=course_info_json)
 
 @app.get("/user_info_multiple/{pids}")
 async def user_info_multiple(pids: str):
@@ -1069,70 +1644,76 @@ async def user_info_multiple(pids: str):
 	for id in pids.split(","):
 		corrected_pids.append(int(id))
 
-	if len(corrected_pids) > 500:
-		return ORJSONResponse(status_code=400, content={"error": "Number of pids requested must be between 1 and 500"})
+	if len(corrected_pids) > bulk_max_ids:
+		return ORJSONResponse(status_code=400, content={"error": "Number of pids requested must be between 1 and %d" % bulk_max_ids})
 
-	await check_tokens()
-	async with lock:
-		async with backend.connect(s, HOST, PORT) as be:
-			async with be.login(str(user_id), auth_info=auth_info) as client:
-				store = datastore.DataStoreClientSMM2(client)
-				print("Want user infos for " + pids)
-
-				# Get user info for all pids				
-				param = datastore.GetUsersParam()
-				param.pids = corrected_pids
-				param.option = datastore.UserOption.ALL
-				response = await store.get_users(param)
-
-				# Filter out invalid users
-				# Can be determined by checking for a pid of 0
-				valid_users = []
-				for user in response.users:
-					if user.pid != 0:
-						valid_users.append(user)
-
-				# Put user info into a JSON object
-				user_info_json = {"users": []}
-				i = 0
-				for user in valid_users:
-					user_info_json["users"].append({})
-					add_user_info_json(user, user_info_json["users"][i])
-					i += 1
-
-				return ORJSONResponse(content=user_info_json)
+	print("Want user infos for " + pids)
+
+	if len(corrected_pids) <= 500:
+		# Get user info for all pids, merged with other requests made at the same time
+		found = await asyncio.gather(*[user_batcher.get(pid) for pid in corrected_pids])
+		users = await users_json(found)
+	else:
+		users = await fetch_users(corrected_pids)
+
+	# Put user info into a JSON object, in the order requested
+	user_info_json = {"users": []}
+	for pid in corrected_pids:
+		if str(pid) in users:
+			user_info_json["users"].append(users[str(pid)])
+
+	return ORJSONResponse(content=user_info_json)
+
+@app.get("/export_courses")
+async def export_courses_range(start: int, end: int, cursor: int = None):
+	# Streams every course from start to end inclusive as NDJSON, one course per line
+	# followed by a cursor line after every batch of 500, pass it as cursor to resume
+	if cursor is not None:
+		start = cursor
+	if start < 0 or end < start:
+		return ORJSONResponse(status_code=400, content={"error": "Invalid data_id range"})
+
+	print("Exporting courses %d to %d" % (start, end))
+	return StreamingResponse(export_courses(data_id_range_batches(start, end)), media_type="application/x-ndjson")
+
+@app.post("/export_courses")
+async def export_courses_list(request: Request, cursor: int = 0):
+	# Same as above for an uploaded list of data_ids, as a JSON array or separated by commas or whitespace
+	body = await request.body()
+	try:
+		if body.lstrip().startswith(b"["):
+			data_ids = [int(data_id) for data_id in orjson.loads(body)]
+		else:
+			data_ids = [int(data_id) for data_id in body.replace(b",", b" ").split()]
+	except (ValueError, TypeError):
+		return ORJSONResponse(status_code=400, content={"error": "data_ids must be integers"})
+
+	print("Exporting %d courses from %d" % (len(data_ids), cursor))
+	return StreamingResponse(export_courses(data_id_list_batches(data_ids, cursor)), media_type="application/x-ndjson")
 
 @app.get("/level_comments/{course_id}")
-async def read_level_comments(course_id: str, noCaching: bool = True):
+async def read_level_comments(request: Request, course_id: str, noCaching: bool = True):
 	course_id = correct_course_id(course_id)
 	print("Want comments for " + course_id)
-	path = "cache/level_comments/%s" % course_id
 
 	if invalid_course_id_length(course_id):
 		return ORJSONResponse(status_code=400, content={"error": "Invalid course ID", "course_id": course_id})
 	if is_maker_id(course_id):
 		return ORJSONResponse(status_code=400, content={"error": "Code corresponds to a maker", "course_id": course_id})
 
-	os.makedirs(os.path.dirname(path), exist_ok=True)
-
-	if pathlib.Path(path).exists() and not noCaching:
-		comments = await add_comment_info_json(None, course_id, None)
-		if invalid_level(comments):
-			return ORJSONResponse(status_code=400, content=comments)
-		return ORJSONResponse(content=comments)
-	else:
-		await check_tokens()
-		async with lock:
-			async with backend.connect(s, HOST, PORT) as be:
-				async with be.login(str(user_id), auth_info=auth_info) as client:
-					store = datastore.DataStoreClientSMM2(client)
-					course_info_json = await obtain_course_info(course_id, store)
-					if invalid_level(course_info_json):
-						return ORJSONResponse(status_code=400, content=course_info_json)
-					comments = await add_comment_info_json(store, course_id, course_info_json, noCaching)
-					if invalid_level(comments):
-						return ORJSONResponse(status_code=400, content=comments)
-					return ORJSONResponse(content=comments)
+	if not noCaching:
+		entry = await cache_lookup("level_comments", course_id)
+		if entry is not None:
+			if is_stale("level_comments", entry):
+				revalidate(("level_comments", course_id), lambda: coalesced(("level_comments", course_id, "refresh"),
+					lambda store: fetch_level_comments(store, course_id, True, True)))
+			return cached_response("level_comments", entry, request)
+
+	comments = await coalesced(("level_comments", course_id, noCaching),
+		lambda store: fetch_level_comments(store, course_id, noCaching, not noCaching))
+	if invalid_level(comments):
+		return ORJSONResponse(status_code=400, content=comments)
+	return ORJSONResponse(content=comments)
 
 @app.get(
 	"/level_thumbnail/{course_id}",
@@ -1143,37 +1724,44 @@ async def read_level_comments(course_id: str, noCaching: bool = True):
 	},
 	response_class=Response
 )
-async def read_level_thumbnail(course_id: str, noCaching: bool = True):
-	course_id = correct_course_id(course_id)
-	# Download thumbnails
+async def read_level_thumbnail(course_id: str, noCaching: bool = True, size: int = None):
 	print("Want thumbnail for " + course_id)
-	path = "cache/level_thumbnail/%s.jpg" % course_id
-	os.makedirs(os.path.dirname(path), exist_ok=True)
+	return await read_thumbnail(course_id, ServerDataTypes.level_thumbnail, noCaching, size)
 
-	if pathlib.Path(path).exists() and not noCaching:
-		return FileResponse(path=path, media_type="image/jpg")
+@app.get(
+	"/entire_level_thumbnail/{course_id}",
+	responses = {
+		200: {
+			"content": {"image/jpg": {}}
+		}
+	},
+	response_class=Response
+)
+async def read_entire_level_thumbnail(course_id: str, noCaching: bool = True, size: int = None):
+	print("Want entire thumbnail for " + course_id)
+	return await read_thumbnail(course_id, ServerDataTypes.entire_level_thumbnail, noCaching, size)
 
-	course_info_json = None
-	if (in_cache(course_id) or invalid_course_id_length(course_id)) and not noCaching:
-		course_info_json = await obtain_course_info(course_id, None)
-		if invalid_level(course_info_json):
-			return ORJSONResponse(status_code=400, content=course_info_json)
+@app.get(
+	"/entire_level_thumbnail_multiple/{course_ids}",
+	responses = {
+		200: {
+			"content": {"application/x-tar": {}}
+		}
+	},
+	response_class=Response
+)
+async def read_entire_level_thumbnails(course_ids: str, noCaching: bool = False, size: int = None):
+	# Tar of <course_id>.jpg files, courses without a thumbnail are listed in missing.json
+	if invalid_thumbnail_size(size):
+		return ORJSONResponse(status_code=400, content={"error": "size must be one of %s" % ", ".join(str(size) for size in thumbnail_sizes)})
 
-	if not noCaching:
-		if in_cache(course_id) and await download_thumbnail(None, course_info_json["one_screen_thumbnail"]["url"], path, ServerDataTypes.level_thumbnail) and not noCaching:
-			return FileResponse(path=path, media_type="image/jpg")
-	else:
-		await check_tokens()
-		async with lock:
-			async with backend.connect(s, HOST, PORT) as be:
-				async with be.login(str(user_id), auth_info=auth_info) as client:
-					store = datastore.DataStoreClientSMM2(client)
-					if course_info_json == None:
-						course_info_json = await obtain_course_info(course_id, store)
-					if invalid_level(course_info_json):
-						return ORJSONResponse(status_code=400, content=course_info_json)
-					await download_thumbnail(store, course_info_json["one_screen_thumbnail"]["url"], path, ServerDataTypes.level_thumbnail)
-					return FileResponse(path=path, media_type="image/jpg")
+	corrected_course_ids = list(dict.fromkeys(correct_course_id(id) for id in course_ids.split(",")))
+	if len(corrected_course_ids) > bulk_max_ids:
+		return ORJSONResponse(status_code=400, content={"error": "Number of courses requested must be between 1 and %d" % bulk_max_ids})
+
+	print("Want entire thumbnails for %d courses" % len(corrected_course_ids))
+	return StreamingResponse(thumbnail_archive(corrected_course_ids, ServerDataTypes.entire_level_thumbnail, noCaching, size),
+		media_type="application/x-tar", headers={"Content-Disposition": "attachment; filename=\"entire_level_thumbnails.tar\""})
 
 @app.get(
 	"/level_data/{data_id}",
@@ -1186,102 +1774,168 @@ async def read_level_thumbnail(course_id: str, noCaching: bool = True):
 )
 async def read_level_data(data_id: int):
 	print("Want course data for dataid %d" % data_id)
-	loc = "cache/level_data_dataid/%s.bcd" % data_id
-	os.makedirs(os.path.dirname(loc), exist_ok=True)
+	body = await obtain_level_data(data_id)
+	if body is None:
+		return ORJSONResponse(status_code=400, content={"error": "Level data file cannot be downloaded", "data_id": data_id})
+	return Response(content=body, media_type="application/octet-stream")
 
-	if pathlib.Path(loc).exists():
-		if os.stat(loc).st_size == 0:
-			os.remove(loc)
-			return ORJSONResponse(status_code=400, content={"error": "Level data file cannot be downloaded", "data_id": data_id})
-		else:
-			return FileResponse(path=loc, media_type="application/octet-stream")
+@app.get(
+	"/level_data_decrypted/{data_id}",
+	responses = {
+		200: {
+			"content": {"application/octet-stream": {}}
+		}
+	},
+	response_class=Response
+)
+async def read_level_data_decrypted(data_id: int):
+	print("Want decrypted course data for dataid %d" % data_id)
+	body = await obtain_level_data(data_id)
+	if body is None:
+		return ORJSONResponse(status_code=400, content={"error": "Level data file cannot be downloaded", "data_id": data_id})
+	decrypted = await cpu.run_thread("level_store_get", level_store.get_decrypted, data_id)
+	if decrypted is None:
+		decrypted = await cpu.run("decrypt_bcd", encryption.decrypt_bcd, body)
+	return Response(content=decrypted, media_type="application/octet-stream")
+
+@app.get("/level_parsed/{data_id}")
+async def read_level_parsed(request: Request, data_id: int):
+	print("Want parsed course data for dataid %d" % data_id)
+	body = await obtain_level_data(data_id)
+	if body is None:
+		return ORJSONResponse(status_code=400, content={"error": "Level data file cannot be downloaded", "data_id": data_id})
+
+	# Parsed once per distinct course, reuploads of the same course share the entry
+	row = level_store.lookup(data_id)
+	digest = row[0] if row is not None else None
+	if digest is not None:
+		entry = await cache_lookup("level_parsed", digest)
+		if entry is not None:
+			return cached_response("level_parsed", entry, request)
+
+	decrypted = await cpu.run_thread("level_store_get", level_store.get_decrypted, data_id) if digest is not None else None
+	if decrypted is None:
+		decrypted = await cpu.run("decrypt_bcd", encryption.decrypt_bcd, body)
+	try:
+		level_json = await cpu.run("parse_level", parse_level, decrypted)
+	except (ValueError, struct.error) as e:
+		return ORJSONResponse(status_code=400, content={"error": "Level data could not be parsed: %s" % e, "data_id": data_id})
+
+	if digest is not None:
+		await cache_save("level_parsed", digest, level_json)
+	return ORJSONResponse(content=level_json)
 
-	await check_tokens()
-	async with lock:
-		async with backend.connect(s, HOST, PORT) as be:
-			async with be.login(str(user_id), auth_info=auth_info) as client:
-				store = datastore.DataStoreClientSMM2(client)
-				param = datastore.DataStorePrepareGetParam()
-				param.data_id = data_id
-				try:
-					req_info = await store.prepare_get_object(param)
-				except:
-					with open(loc, "wb") as f:
-						return ORJSONResponse(status_code=400, content={"error": "Level data file cannot be downloaded", "data_id": data_id})
-				response = await http.get(req_info.url)
-				response.raise_if_error()
-				with open(loc, "wb") as f:
-					f.write(response.body)
-					return Response(content=response.body, media_type="application/octet-stream")
+@app.get(
+	"/level_data_multiple/{data_ids}",
+	responses = {
+		200: {
+			"content": {"application/x-tar": {}}
+		}
+	},
+	response_class=Response
+)
+async def read_level_data_multiple(data_ids: str):
+	# Tar of <data_id>.bcd files, levels that could not be downloaded are listed in missing.json
+	corrected_data_ids = list(dict.fromkeys(int(id) for id in data_ids.split(",")))
+
+	if len(corrected_data_ids) > bulk_max_ids:
+		return ORJSONResponse(status_code=400, content={"error": "Number of courses requested must be between 1 and %d" % bulk_max_ids})
+
+	print("Want course data for %d dataids" % len(corrected_data_ids))
+	return StreamingResponse(level_data_archive(corrected_data_ids), media_type="application/x-tar",
+		headers={"Content-Disposition": "attachment; filename=\"level_data.tar\""})
 
 @app.get("/get_posted/{maker_id}")
-async def search_posted(maker_id: str):
+async def search_posted(maker_id: str, users: str = None):
+	if invalid_users_mode(users):
+		return ORJSONResponse(status_code=400, content={"error": "users must be embed or table"})
+
 	maker_id = correct_course_id(maker_id)
 
 	user_info_json = None
 	if (in_user_cache(maker_id) or invalid_course_id_length(maker_id) or not is_maker_id(maker_id)):
-		user_info_json = await obtain_user_info(maker_id, None)
+		user_info_json = await obtain_user_info(maker_id, None, False)
 		if invalid_level(user_info_json):
 			return ORJSONResponse(status_code=400, content=user_info_json)
 
 	await check_tokens()
-	async with lock:
-		async with backend.connect(s, HOST, PORT) as be:
-			async with be.login(str(user_id), auth_info=auth_info) as client:
-				store = datastore.DataStoreClientSMM2(client)
-				print("Want uploaded courses from %s" % maker_id)
-				if user_info_json == None:
-					user_info_json = await obtain_user_info(maker_id, store)
+	async with limiter.slot():
+		async with session_pool.session() as store:
+			print("Want uploaded courses from %s" % maker_id)
+			if user_info_json == None:
+				user_info_json = await obtain_user_info(maker_id, store)
+				if invalid_level(user_info_json):
+					return ORJSONResponse(status_code=400, content=user_info_json)
+
+			courses_info_json = await get_courses_posted(100, user_info_json["pid"], store)
 
-				courses_info_json = await get_courses_posted(100, user_info_json["pid"], store)
+	if invalid_level(courses_info_json):
+		return ORJSONResponse(status_code=400, content=courses_info_json)
 
-				if invalid_level(courses_info_json):
-					return ORJSONResponse(status_code=400, content=courses_info_json)
+	# The session is released first, the users are fetched on sessions of their own
+	if users is not None:
+		await add_users_json(courses_info_json["courses"], users, courses_info_json)
 
-				return ORJSONResponse(content=courses_info_json)
+	return ORJSONResponse(content=courses_info_json)
 
 @app.get("/super_worlds/{map_ids}")
 async def get_world_maps(map_ids: str):
 	corrected_map_ids = []
 	for id in map_ids.split(","):
-		corrected_map_ids.append(id)
-	
-	await check_tokens()
-	async with lock:
-		async with backend.connect(s, HOST, PORT) as be:
-			async with be.login(str(user_id), auth_info=auth_info) as client:
-				store = datastore.DataStoreClientSMM2(client)
-				print("Want world maps %s" % map_ids)
-				world_maps = await search_world_map(store, corrected_map_ids)
+		corrected_map_ids.append(id.strip())
+
+	print("Want world maps %s" % map_ids)
+	world_maps = await coalesced(("super_worlds", tuple(corrected_map_ids)),
+		lambda store: search_world_map(store, corrected_map_ids))
 
-				if invalid_level(world_maps):
-					return ORJSONResponse(status_code=400, content=world_maps)
+	if invalid_level(world_maps):
+		return ORJSONResponse(status_code=400, content=world_maps)
 
-				return ORJSONResponse(content=world_maps)
+	return ORJSONResponse(content=world_maps)
 
 @app.get("/newest_data_id")
 async def newest_data_id():
+	# Kept up to date by the follower
+	if follower.high_water is not None:
+		return ORJSONResponse(content={"data_id": follower.high_water})
+
 	count = 100
 	await check_tokens()
-	async with lock:
-		async with backend.connect(s, HOST, PORT) as be:
-			async with be.login(str(user_id), auth_info=auth_info) as client:
-				store = datastore.DataStoreClientSMM2(client)
-				print("Want %d latest courses" % count)
-				courses_info_json = await search_latest_courses(count, store)
-
-				if invalid_level(courses_info_json):
-					return ORJSONResponse(status_code=400, content=courses_info_json)
-
-				# Calculate max data_id from the JSON array
-				max_data_id = 0
-				for course_info in courses_info_json["courses"]:
-					if course_info["data_id"] > max_data_id:
-						max_data_id = course_info["data_id"]
-
-				# Put the max data_id into a new JSON object
-				return ORJSONResponse(content={"data_id": max_data_id})
-
-loop_handler = AsyncLoopThread()
-loop_handler.start()
-asyncio.run_coroutine_threadsafe(main(), loop_handler.loop)
\ No newline at end of file
+	async with limiter.slot():
+		async with session_pool.session() as store:
+			print("Want %d latest courses" % count)
+			courses_info_json = await search_latest_courses(count, store)
+
+			if invalid_level(courses_info_json):
+				return ORJSONResponse(status_code=400, content=courses_info_json)
+
+			# Calculate max data_id from the JSON array
+			max_data_id = 0
+			for course_info in courses_info_json["courses"]:
+				if course_info["data_id"] > max_data_id:
+					max_data_id = course_info["data_id"]
+
+			# Put the max data_id into a new JSON object
+			return ORJSONResponse(content={"data_id": max_data_id})
+
+@app.get("/new_courses")
+async def new_courses(after: int = None, timeout: float = 30):
+	# Long poll, answers as soon as courses newer than after are uploaded or after timeout seconds
+	if not follow_latest_interval:
+		return ORJSONResponse(status_code=400, content={"error": "Following new courses is disabled"})
+	if after is None:
+		after = follower.high_water or 0
+	courses = await follower.wait(after, min(max(timeout, 0), 60))
+	return ORJSONResponse(content={"courses": courses, "data_id": follower.high_water})
+
+@app.get("/new_courses/stream")
+async def new_courses_stream(request: Request, after: int = None):
+	# Server sent events, one course event per new course
+	if not follow_latest_interval:
+		return ORJSONResponse(status_code=400, content={"error": "Following new courses is disabled"})
+	if request.headers.get("last-event-id", "").isdigit():
+		# Sent by browsers when they reconnect
+		after = int(request.headers["last-event-id"])
+	if after is None:
+		after = follower.high_water or 0
+	return StreamingResponse(course_events(after), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
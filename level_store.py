@@ -0,0 +1,117 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from cache_store import atomic_write
+from SMM2 import encryption
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+class LevelStore:
+	# Level data stored once per distinct decrypted course, compressed and named by its sha256.
+	# The index maps data_ids to that hash plus what is needed to encrypt the file exactly as it was downloaded
+	def __init__(self, root = "cache/level_data", level = 3):
+		self.root = root
+		os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+		self.level = level
+		self.lock = threading.Lock()
+
+		self.db = sqlite3.connect(os.path.join(root, "index.sqlite3"), timeout=30, check_same_thread=False, isolation_level=None)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		# A NULL hash remembers that the level cannot be downloaded
+		self.db.execute("""CREATE TABLE IF NOT EXISTS levels (
+			data_id INTEGER PRIMARY KEY,
+			hash TEXT,
+			header BLOB,
+			iv BLOB,
+			seed BLOB,
+			stored_at REAL NOT NULL
+		)""")
+
+		self.stored = 0
+		self.deduplicated = 0
+
+	def object_path(self, digest, extension):
+		return os.path.join(self.root, "objects", digest[:2], digest + extension)
+
+	def compress(self, data):
+		if zstandard is not None:
+			return zstandard.ZstdCompressor(level=self.level).compress(data), ".zst"
+		return zlib.compress(data, self.level), ".zz"
+
+	def read_object(self, digest):
+		try:
+			with open(self.object_path(digest, ".zst"), "rb") as f:
+				if zstandard is None:
+					raise RuntimeError("Level %s is compressed with zstd but zstandard is not installed" % digest)
+				return zstandard.ZstdDecompressor().decompress(f.read())
+		except FileNotFoundError:
+			pass
+		with open(self.object_path(digest, ".zz"), "rb") as f:
+			return zlib.decompress(f.read())
+
+	def has_object(self, digest):
+		return os.path.exists(self.object_path(digest, ".zst")) or os.path.exists(self.object_path(digest, ".zz"))
+
+	def put(self, data_id, data):
+		# data is the encrypted file as downloaded
+		decrypted = encryption.decrypt_bcd_buffer(data)
+		header, iv, seed = encryption.split_bcd(data)
+		digest = hashlib.sha256(decrypted).hexdigest()
+
+		if self.has_object(digest):
+			self.deduplicated += 1
+		else:
+			compressed, extension = self.compress(decrypted)
+			os.makedirs(os.path.dirname(self.object_path(digest, extension)), exist_ok=True)
+			atomic_write(self.object_path(digest, extension), compressed)
+			self.stored += 1
+
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO levels (data_id, hash, header, iv, seed, stored_at) VALUES (?, ?, ?, ?, ?, ?)",
+				(data_id, digest, header, iv, seed, time.time()))
+		return digest
+
+	def mark_missing(self, data_id):
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO levels (data_id, hash, header, iv, seed, stored_at) VALUES (?, NULL, NULL, NULL, NULL, ?)",
+				(data_id, time.time()))
+
+	def forget(self, data_id):
+		with self.lock:
+			self.db.execute("DELETE FROM levels WHERE data_id = ?", (data_id,))
+
+	def lookup(self, data_id):
+		# None if the level was never stored, otherwise (hash, header, iv, seed) with a None hash if it is missing
+		with self.lock:
+			return self.db.execute("SELECT hash, header, iv, seed FROM levels WHERE data_id = ?", (data_id,)).fetchone()
+
+	def get_decrypted(self, data_id):
+		row = self.lookup(data_id)
+		if row is None or row[0] is None:
+			return None
+		return self.read_object(row[0])
+
+	def get(self, data_id):
+		# The encrypted file, identical to the one that was downloaded
+		row = self.lookup(data_id)
+		if row is None or row[0] is None:
+			return None
+		return encryption.encrypt_bcd(self.read_object(row[0]), header=row[1], iv=row[2], seed=row[3])
+
+	def metrics(self):
+		return {
+			"stored": self.stored,
+			"deduplicated": self.deduplicated,
+			"compression": "zstd" if zstandard is not None else "zlib"
+		}
+
+	def close(self):
+		self.db.close()
@@ -0,0 +1,192 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+from collections import deque
+
+import logging
+logger = logging.getLogger(__name__)
+
+PRIORITIES = ["interactive", "bulk"]
+
+# The RPCs made inside the current slot, as (priority, name, latency)
+slot_calls = contextvars.ContextVar("slot_calls", default=None)
+
+class TimedStore:
+	# Wraps a datastore client so the limiter sees how long each RPC took, without the session
+	# checkout, login or JSON work that happens inside the same slot
+	def __init__(self, store):
+		self.store = store
+
+	def __getattr__(self, name):
+		attribute = getattr(self.store, name)
+		if not asyncio.iscoroutinefunction(attribute):
+			return attribute
+		async def timed(*args, **kwargs):
+			start = time.monotonic()
+			result = await attribute(*args, **kwargs)
+			calls = slot_calls.get()
+			if calls is not None:
+				calls.append((name, time.monotonic() - start))
+			return result
+		return timed
+
+class AdaptiveLimiter:
+	def __init__(self, initial = 3, min_limit = 1, max_limit = 12, tolerance = 2.0, backoff = 0.7, bulk_share = 0.5):
+		# AIMD: the limit grows by one per limit successful calls while latency stays within tolerance
+		# times the best latency seen, and is multiplied by backoff on errors or slow calls.
+		# Latency is compared per priority and RPC, a 500 course chunk is never held to the
+		# time of a single lookup
+		self.limit = float(initial)
+		self.min_limit = min_limit
+		self.max_limit = max_limit
+		self.tolerance = tolerance
+		self.backoff = backoff
+		# Bulk calls never take more than this share of the limit so interactive ones always get through
+		self.bulk_share = bulk_share
+
+		self.in_flight = {priority: 0 for priority in PRIORITIES}
+		self.waiters = {priority: deque() for priority in PRIORITIES}
+		self.baseline = {}
+		self.latency = {}
+		self.round_trip = None
+		self.last_decrease = 0
+
+		self.calls = 0
+		self.errors = 0
+		self.increases = 0
+		self.decreases = 0
+
+	def current_limit(self):
+		return max(self.min_limit, int(self.limit))
+
+	def total_in_flight(self):
+		return sum(self.in_flight.values())
+
+	def demand(self):
+		# Calls in flight and calls waiting for a slot. Bulk calls are held to their share of the
+		# limit, so in flight alone never reaches the limit when only bulk work is running
+		return self.total_in_flight() + sum(len(waiters) for waiters in self.waiters.values())
+
+	def has_room(self, priority):
+		if self.total_in_flight() >= self.current_limit():
+			return False
+		if priority == "bulk":
+			return self.in_flight["bulk"] < max(1, int(self.current_limit() * self.bulk_share))
+		return True
+
+	@contextlib.asynccontextmanager
+	async def slot(self, priority = "interactive"):
+		await self.acquire(priority)
+		calls = []
+		token = slot_calls.set(calls)
+		try:
+			yield
+		except Exception:
+			self.release(priority)
+			self.on_error()
+			raise
+		except BaseException:
+			# Cancelled, says nothing about the upstream servers
+			self.release(priority)
+			raise
+		else:
+			self.release(priority)
+			# Nothing to learn from slots that made no RPC
+			if len(calls) != 0:
+				self.on_success(priority, calls)
+		finally:
+			slot_calls.reset(token)
+
+	async def acquire(self, priority):
+		if len(self.waiters["interactive"]) == 0 and (priority == "interactive" or len(self.waiters["bulk"]) == 0) and self.has_room(priority):
+			self.in_flight[priority] += 1
+			return
+
+		future = asyncio.get_running_loop().create_future()
+		self.waiters[priority].append(future)
+		try:
+			await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				# The slot was handed over right as the caller was cancelled
+				self.release(priority)
+			else:
+				self.waiters[priority].remove(future)
+			raise
+
+	def release(self, priority):
+		self.in_flight[priority] -= 1
+		self.wake()
+
+	def wake(self):
+		# Slots are handed to waiting interactive calls first
+		for priority in PRIORITIES:
+			waiters = self.waiters[priority]
+			while len(waiters) != 0 and self.has_room(priority):
+				future = waiters.popleft()
+				if future.done():
+					continue
+				self.in_flight[priority] += 1
+				future.set_result(None)
+
+	def observe(self, key, latency):
+		# Returns whether the call was slow for its kind
+		slow = key in self.baseline and latency > self.baseline[key] * self.tolerance
+		if key not in self.baseline or latency < self.baseline[key]:
+			self.baseline[key] = latency
+		else:
+			# Let the baseline follow the servers if they stay slower for a long time
+			self.baseline[key] += (latency - self.baseline[key]) * 0.01
+		if key not in self.latency:
+			self.latency[key] = latency
+		else:
+			self.latency[key] += (latency - self.latency[key]) * 0.1
+		if self.round_trip is None:
+			self.round_trip = latency
+		else:
+			self.round_trip += (latency - self.round_trip) * 0.1
+		return slow
+
+	def on_success(self, priority, calls):
+		self.calls += 1
+		slow = False
+		for name, latency in calls:
+			if self.observe((priority, name), latency):
+				slow = True
+
+		if slow:
+			self.decrease()
+		elif self.demand() + 1 >= self.current_limit() and self.limit < self.max_limit:
+			# Only grow when there is more work than the current limit lets through
+			self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+			self.increases += 1
+			self.wake()
+
+	def on_error(self):
+		self.calls += 1
+		self.errors += 1
+		self.decrease()
+
+	def decrease(self):
+		# Calls that were already in flight finish slow too, back off at most once per round trip
+		now = time.monotonic()
+		if now - self.last_decrease < (self.round_trip or 0):
+			return
+		self.last_decrease = now
+		self.limit = max(self.min_limit, self.limit * self.backoff)
+		self.decreases += 1
+		logger.info("Upstream concurrency limit lowered to %d", self.current_limit())
+
+	def metrics(self):
+		return {
+			"limit": self.current_limit(),
+			"in_flight": dict(self.in_flight),
+			"queued": {priority: len(waiters) for priority, waiters in self.waiters.items()},
+			"latency": {"%s %s" % key: latency for key, latency in self.latency.items()},
+			"baseline_latency": {"%s %s" % key: latency for key, latency in self.baseline.items()},
+			"calls": self.calls,
+			"errors": self.errors,
+			"increases": self.increases,
+			"decreases": self.decreases
+		}
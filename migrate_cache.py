@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+from cache_store import NAMESPACES, open_cache
+from level_store import LevelStore
+
+# Imports the old cache/<namespace>/<key> files into the cache store configured in webserver_args.json
+
+args = {}
+if os.path.exists("webserver_args.json"):
+	with open("webserver_args.json") as f:
+		args = json.load(f)
+
+source = "cache"
+if len(sys.argv) > 1:
+	source = sys.argv[1]
+
+def migrate_level_data():
+	directory = os.path.join(source, "level_data_dataid")
+	if not os.path.isdir(directory):
+		return
+
+	level_store = LevelStore(args.get("level_data_path", "cache/level_data"))
+	count = 0
+	with os.scandir(directory) as entries:
+		for entry in entries:
+			if not entry.is_file() or not entry.name.endswith(".bcd"):
+				continue
+			# Empty files were markers for levels that could not be downloaded, they are tried again
+			if entry.stat().st_size != 0:
+				with open(entry.path, mode="rb") as f:
+					level_store.put(int(entry.name[:-4]), f.read())
+				count += 1
+				if count % 1000 == 0:
+					print("level_data: %d imported" % count)
+			os.remove(entry.path)
+	level_store.close()
+	print("level_data: %d imported, %d stored after deduplication" % (count, level_store.stored))
+
+migrate_level_data()
+
+if args.get("cache_backend", "sqlite") == "files":
+	print("Cache backend is already files, nothing else to migrate")
+	exit(0)
+
+cache = open_cache(args.get("cache_backend", "sqlite"), args.get("cache_path"))
+
+for namespace in NAMESPACES:
+	directory = os.path.join(source, namespace)
+	if not os.path.isdir(directory):
+		continue
+
+	count = 0
+	with os.scandir(directory) as entries:
+		for entry in entries:
+			if not entry.is_file():
+				continue
+			with open(entry.path, mode="rb") as f:
+				# Keep the original write time so the entry ages like it did on disk
+				cache.put(namespace, entry.name, f.read(), entry.stat().st_mtime)
+			if cache.flush_due():
+				cache.flush()
+			count += 1
+			if count % 10000 == 0:
+				print("%s: %d imported" % (namespace, count))
+	cache.flush()
+	print("%s: %d imported" % (namespace, count))
+
+cache.close()
+print("Done, the old directories can be removed once the server has been checked")
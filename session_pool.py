@@ -0,0 +1,330 @@
+import asyncio
+import contextlib
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+	import anyio
+	STREAM_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)
+except ImportError:
+	STREAM_ERRORS = ()
+
+def connection_error(e):
+	# True for errors that leave the NEX connection unusable. RMC errors are answers from the
+	# server on a working connection, everything else comes from the code using the session
+	if isinstance(e, (OSError, EOFError, asyncio.TimeoutError) + STREAM_ERRORS):
+		return True
+	# The RMC and PRUDP clients raise a RuntimeError once their connection is gone
+	return isinstance(e, RuntimeError) and "connection" in str(e)
+
+class PooledSession:
+	def __init__(self, pool):
+		self.pool = pool
+		self.generation = pool.generation
+		self.store = None
+		self.error = None
+		self.task = None
+		self.users = 0
+		self.broken = False
+		self.ready = asyncio.Event()
+		self.closing = asyncio.Event()
+
+	async def run(self):
+		# The NEX connection is made of nested context managers that have to be
+		# entered and exited from the same task, so every session gets its own
+		# task that keeps them open until the session is closed
+		try:
+			async with self.pool.connect() as store:
+				self.store = store
+				self.ready.set()
+				await self.closing.wait()
+		except Exception as e:
+			self.error = e
+			logger.warning("NEX session closed with error: %s", e)
+		finally:
+			self.store = None
+			self.ready.set()
+
+	def alive(self):
+		return self.store is not None and not self.task.done()
+
+	def close(self):
+		self.closing.set()
+
+class SessionPool:
+	def __init__(self, connect, size = 3, streams = 1, health_check = None, health_check_interval = 60, health_check_timeout = 10):
+		# connect returns an async context manager yielding a logged in store.
+		# A session can be used by up to streams requests at once, RMC calls on one connection don't block each other
+		self.connect = connect
+		self.size = size
+		self.streams = streams
+		self.health_check = health_check
+		self.health_check_interval = health_check_interval
+		self.health_check_timeout = health_check_timeout
+
+		self.generation = 0
+		self.sessions = set()
+		self.idle = []
+		self.busy = set()
+		self.opening = 0
+		self.in_use = 0
+		self.waiting = 0
+		self.slots = None
+		self.changed = None
+		self.monitor_task = None
+
+		self.opened = 0
+		self.closed = 0
+		self.failed_connects = 0
+		self.failed_health_checks = 0
+
+	def invalidate(self):
+		# Sessions logged in with an older token are replaced the next time they are touched
+		self.generation += 1
+		self.notify()
+
+	def notify(self):
+		# Wakes the requests waiting for a session to open or free up
+		if self.changed is not None:
+			self.changed.set()
+			self.changed = None
+
+	async def wait_for_change(self):
+		if self.changed is None:
+			self.changed = asyncio.Event()
+		await self.changed.wait()
+
+	def start(self):
+		if self.slots is None:
+			self.slots = asyncio.Semaphore(self.size * self.streams)
+		if self.monitor_task is None or self.monitor_task.done():
+			self.monitor_task = asyncio.create_task(self.monitor())
+
+	@contextlib.asynccontextmanager
+	async def session(self):
+		self.start()
+		self.waiting += 1
+		try:
+			await self.slots.acquire()
+		finally:
+			self.waiting -= 1
+
+		session = None
+		try:
+			session = await self.checkout()
+			yield session.store
+		except Exception as e:
+			# The connection may be in an unknown state, never hand it out again.
+			# It is closed once the other requests using it are done
+			if session is not None and connection_error(e):
+				session.broken = True
+			raise
+		finally:
+			if session is not None:
+				self.checkin(session)
+			self.slots.release()
+
+	async def checkout(self):
+		session = None
+		while session is None:
+			while len(self.idle) != 0:
+				session = self.idle.pop()
+				if self.usable(session):
+					break
+				self.discard(session)
+				session = None
+			if session is not None:
+				break
+
+			shared = [busy for busy in self.busy if busy.users < self.streams and self.usable(busy)]
+			if self.open_count() < self.size:
+				# Spread requests over separate connections before sharing one
+				session = await self.open()
+			elif len(shared) != 0:
+				session = min(shared, key=lambda busy: busy.users)
+			else:
+				# Every session is still logging in, wait for one of them instead of
+				# logging in more than size times
+				await self.wait_for_change()
+
+		session.users += 1
+		self.busy.add(session)
+		self.in_use += 1
+		return session
+
+	def checkin(self, session):
+		session.users -= 1
+		self.in_use -= 1
+		self.notify()
+		if session.users != 0:
+			return
+		self.busy.discard(session)
+		if self.usable(session):
+			self.idle.append(session)
+		else:
+			self.discard(session)
+
+	def usable(self, session):
+		return session.generation == self.generation and not session.broken and session.alive()
+
+	def open_count(self):
+		# Sessions still finishing requests that will be closed afterwards don't count
+		return len(self.sessions) + self.opening - len([busy for busy in self.busy if not self.usable(busy)])
+
+	async def open(self):
+		session = PooledSession(self)
+		session.task = asyncio.create_task(session.run())
+		self.opening += 1
+		try:
+			await session.ready.wait()
+		finally:
+			self.opening -= 1
+			self.notify()
+		if session.store is None:
+			self.failed_connects += 1
+			if session.error is not None:
+				raise session.error
+			raise ConnectionError("Could not open NEX session")
+		self.sessions.add(session)
+		self.opened += 1
+		return session
+
+	def discard(self, session):
+		if session in self.sessions:
+			self.sessions.remove(session)
+			self.closed += 1
+		session.close()
+
+	async def monitor(self):
+		while True:
+			try:
+				await self.fill()
+				await self.check_idle()
+			except Exception as e:
+				logger.warning("NEX session pool maintenance failed: %s", e)
+			await asyncio.sleep(self.health_check_interval)
+
+	async def fill(self):
+		# Keep the pool topped up so requests rarely pay for a login
+		while self.open_count() < self.size and self.waiting == 0:
+			async with self.slots:
+				if self.open_count() >= self.size:
+					return
+				self.idle.append(await self.open())
+
+	async def check_idle(self):
+		for session in list(self.idle):
+			async with self.slots:
+				if session not in self.idle:
+					continue
+				self.idle.remove(session)
+				if self.usable(session) and await self.healthy(session):
+					self.idle.append(session)
+				else:
+					self.discard(session)
+
+	async def healthy(self, session):
+		if self.health_check is None:
+			return True
+		try:
+			await asyncio.wait_for(self.health_check(session.store), self.health_check_timeout)
+			return True
+		except Exception as e:
+			self.failed_health_checks += 1
+			logger.warning("NEX session failed health check: %s", e)
+			return False
+
+	def metrics(self):
+		return {
+			"size": self.size,
+			"streams": self.streams,
+			"open": len(self.sessions),
+			"busy": len(self.busy),
+			"idle": len(self.idle),
+			"in_use": self.in_use,
+			"waiting": self.waiting,
+			"opened": self.opened,
+			"closed": self.closed,
+			"failed_connects": self.failed_connects,
+			"failed_health_checks": self.failed_health_checks,
+			"generation": self.generation
+		}
+
+class ShardedSessionPool:
+	def __init__(self, shards, error_threshold = 3, error_cooldown = 30):
+		# Spreads requests over one session pool per account. Every shard has a name,
+		# a pool and a credentials manager, accounts that keep failing are skipped for a while
+		self.shards = shards
+		self.error_threshold = error_threshold
+		self.error_cooldown = error_cooldown
+		for shard in shards:
+			shard.consecutive_errors = 0
+			shard.last_error_time = 0
+			shard.requests = 0
+
+	def healthy(self, shard):
+		if shard.credentials.current is None:
+			return False
+		return shard.consecutive_errors < self.error_threshold or (time.monotonic() - shard.last_error_time) > self.error_cooldown
+
+	def load(self, shard):
+		return (shard.pool.in_use + shard.pool.waiting) / (shard.pool.size * shard.pool.streams)
+
+	def pick(self):
+		candidates = [shard for shard in self.shards if self.healthy(shard)]
+		if len(candidates) == 0:
+			# Nothing is known to work, let the least loaded account try anyway
+			candidates = self.shards
+		return min(candidates, key=self.load)
+
+	async def ready(self):
+		# Waits until at least one account has logged in
+		for shard in self.shards:
+			shard.credentials.start()
+		if any(shard.credentials.current is not None for shard in self.shards):
+			return
+		# Returns as soon as the first one succeeds, the others keep logging in in the background
+		pending = [asyncio.ensure_future(shard.credentials.get()) for shard in self.shards]
+		error = None
+		while len(pending) != 0:
+			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				if task.exception() is None:
+					for waiter in pending:
+						waiter.cancel()
+					return
+				if error is None:
+					error = task.exception()
+		raise error
+
+	@contextlib.asynccontextmanager
+	async def session(self):
+		shard = self.pick()
+		shard.requests += 1
+		connected = False
+		try:
+			async with shard.pool.session() as store:
+				connected = True
+				yield store
+		except Exception as e:
+			# Only count the account as failing when it could not connect or lost its connection,
+			# errors caused by the request itself (an unknown course id) say nothing about it
+			if not connected or connection_error(e):
+				shard.consecutive_errors += 1
+				shard.last_error_time = time.monotonic()
+			raise
+		else:
+			shard.consecutive_errors = 0
+
+	def metrics(self):
+		return {
+			shard.name: {
+				"healthy": self.healthy(shard),
+				"requests": shard.requests,
+				"consecutive_errors": shard.consecutive_errors,
+				"credentials": shard.credentials.metrics(),
+				"session_pool": shard.pool.metrics()
+			} for shard in self.shards
+		}
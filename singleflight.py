@@ -0,0 +1,42 @@
+import asyncio
+
+class SingleFlight:
+	def __init__(self):
+		self.calls = {}
+		self.leaders = 0
+		self.followers = 0
+
+	async def do(self, key, fn, *args, **kwargs):
+		# Callers with the same key while a call is running wait for and share its result.
+		# The call runs in its own task, a cancelled caller only stops waiting and the call is
+		# only cancelled once nobody is waiting for it anymore
+		call = self.calls.get(key)
+		if call is None:
+			call = {"task": asyncio.ensure_future(fn(*args, **kwargs)), "waiting": 0}
+			self.calls[key] = call
+			call["task"].add_done_callback(lambda task: self.finish(key, call))
+			self.leaders += 1
+		else:
+			self.followers += 1
+
+		call["waiting"] += 1
+		try:
+			return await asyncio.shield(call["task"])
+		finally:
+			call["waiting"] -= 1
+			if call["waiting"] == 0 and not call["task"].done():
+				call["task"].cancel()
+
+	def finish(self, key, call):
+		if self.calls.get(key) is call:
+			del self.calls[key]
+		# Retrieve the exception so it is not reported as never retrieved when every caller left
+		if not call["task"].cancelled():
+			call["task"].exception()
+
+	def metrics(self):
+		return {
+			"in_flight": len(self.calls),
+			"leaders": self.leaders,
+			"followers": self.followers
+		}
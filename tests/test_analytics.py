@@ -0,0 +1,28 @@
+import struct
+import zlib
+
+import pytest
+
+# SMM2.encryption needs NintendoClients
+pytest.importorskip("nintendo.enl")
+pytest.importorskip("nintendo.sead")
+
+from SMM2.analytics import build_corpus
+from SMM2.level import LEVEL_SIZE
+
+def write_course(path, clear_condition):
+	data = bytearray(LEVEL_SIZE)
+	struct.pack_into("<I", data, 0x10, clear_condition)
+	with open(path, "wb") as f:
+		f.write(zlib.compress(bytes(data)))
+	return str(path)
+
+def test_clear_conditions_are_named(tmp_path):
+	sources = [
+		write_course(tmp_path / "a.zz", 3977257962),
+		write_course(tmp_path / "b.zz", 3977257962),
+		write_course(tmp_path / "c.zz", 0),
+		write_course(tmp_path / "d.zz", 12345)
+	]
+	corpus = build_corpus(str(tmp_path / "corpus.bin"), sources, processes=1)
+	assert corpus.clear_condition_distribution() == {"reach_the_goal_as_super_mario": 2, "none": 1, "12345": 1}
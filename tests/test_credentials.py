@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+import pytest
+
+from credentials import CredentialManager
+
+def test_first_login_is_shared_by_waiting_requests():
+	async def main():
+		logins = []
+		async def generate_device_tokens():
+			logins.append(None)
+			await asyncio.sleep(0.01)
+			return {"device_token": "device"}
+		async def generate_id_token(tokens):
+			return {"id_token": "id"}
+		credentials = CredentialManager(generate_device_tokens, generate_id_token)
+		results = await asyncio.gather(*[credentials.get() for i in range(5)])
+		credentials.task.cancel()
+		return logins, results
+	logins, results = asyncio.run(main())
+	assert len(logins) == 1
+	assert all(result["id_token"] == "id" for result in results)
+
+def test_requests_fail_fast_during_the_backoff():
+	async def main():
+		async def generate_device_tokens():
+			raise ConnectionError("dauth is down")
+		async def generate_id_token(tokens):
+			return {}
+		credentials = CredentialManager(generate_device_tokens, generate_id_token, retry_min=3)
+		with pytest.raises(ConnectionError):
+			await credentials.get()
+		# Arrives after the login failed, while the retry is still seconds away
+		start = time.monotonic()
+		with pytest.raises(ConnectionError):
+			await credentials.get()
+		elapsed = time.monotonic() - start
+		credentials.task.cancel()
+		return elapsed
+	assert asyncio.run(main()) < 0.5
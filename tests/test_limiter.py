@@ -0,0 +1,82 @@
+import asyncio
+
+from limiter import AdaptiveLimiter, TimedStore
+
+class FakeStore:
+	def __init__(self, latency):
+		self.latency = latency
+		self.in_flight = 0
+		self.peak = 0
+
+	async def get_object_infos(self):
+		self.in_flight += 1
+		self.peak = max(self.peak, self.in_flight)
+		try:
+			await asyncio.sleep(self.latency)
+		finally:
+			self.in_flight -= 1
+
+async def run_jobs(limiter, store, priority, count):
+	async def job():
+		async with limiter.slot(priority):
+			await store.get_object_infos()
+	await asyncio.gather(*[job() for i in range(count)])
+
+def test_bulk_only_load_grows_the_limit():
+	async def main():
+		limiter = AdaptiveLimiter()
+		store = FakeStore(0.002)
+		await run_jobs(limiter, TimedStore(store), "bulk", 300)
+		return limiter, store
+	limiter, store = asyncio.run(main())
+	assert limiter.increases > 0
+	assert limiter.current_limit() > 3
+	assert store.peak > 1
+
+def test_bulk_stays_within_its_share():
+	async def main():
+		limiter = AdaptiveLimiter(initial=4, max_limit=4)
+		store = FakeStore(0.002)
+		await run_jobs(limiter, TimedStore(store), "bulk", 50)
+		return store
+	assert asyncio.run(main()).peak == 2
+
+def test_interactive_calls_go_before_queued_bulk_calls():
+	async def main():
+		limiter = AdaptiveLimiter(initial=2, max_limit=2)
+		order = []
+		async def job(priority, name):
+			async with limiter.slot(priority):
+				order.append(name)
+				await asyncio.sleep(0.01)
+		bulk = [asyncio.ensure_future(job("bulk", "bulk%d" % i)) for i in range(3)]
+		await asyncio.sleep(0)
+		await job("interactive", "interactive")
+		await asyncio.gather(*bulk)
+		return order
+	order = asyncio.run(main())
+	assert order.index("interactive") < order.index("bulk1")
+
+def test_slow_calls_lower_the_limit():
+	async def main():
+		limiter = AdaptiveLimiter(initial=6)
+		await run_jobs(limiter, TimedStore(FakeStore(0.001)), "interactive", 1)
+		await run_jobs(limiter, TimedStore(FakeStore(0.05)), "interactive", 1)
+		return limiter
+	limiter = asyncio.run(main())
+	assert limiter.decreases == 1
+	assert limiter.current_limit() < 6
+
+def test_errors_lower_the_limit_and_free_the_slot():
+	async def main():
+		limiter = AdaptiveLimiter(initial=6)
+		try:
+			async with limiter.slot():
+				raise ConnectionError("lost")
+		except ConnectionError:
+			pass
+		return limiter
+	limiter = asyncio.run(main())
+	assert limiter.errors == 1
+	assert limiter.current_limit() < 6
+	assert limiter.total_in_flight() == 0
@@ -0,0 +1,93 @@
+import asyncio
+import contextlib
+
+from session_pool import SessionPool
+
+class FakeServer:
+	def __init__(self, login_time = 0.01):
+		self.login_time = login_time
+		self.logins = 0
+		self.connected = 0
+		self.peak = 0
+
+	@contextlib.asynccontextmanager
+	async def connect(self):
+		self.logins += 1
+		await asyncio.sleep(self.login_time)
+		self.connected += 1
+		self.peak = max(self.peak, self.connected)
+		try:
+			yield object()
+		finally:
+			self.connected -= 1
+
+async def use(pool, time = 0.01, error = None):
+	async with pool.session() as store:
+		await asyncio.sleep(time)
+		if error is not None:
+			raise error
+		return store
+
+def test_cold_burst_logs_in_at_most_size_times():
+	async def main():
+		server = FakeServer()
+		pool = SessionPool(server.connect, size=3, streams=4)
+		stores = await asyncio.gather(*[use(pool) for i in range(12)])
+		return server, pool, stores
+	server, pool, stores = asyncio.run(main())
+	assert server.logins == 3
+	assert server.peak == 3
+	assert len(set(map(id, stores))) == 3
+	assert pool.metrics()["open"] == 3
+
+def test_streams_limit_sharing():
+	async def main():
+		server = FakeServer()
+		pool = SessionPool(server.connect, size=2, streams=2)
+		await asyncio.gather(*[use(pool) for i in range(10)])
+		return server, pool
+	server, pool = asyncio.run(main())
+	assert server.logins == 2
+	assert pool.in_use == 0
+
+def test_request_errors_keep_the_session():
+	async def main():
+		server = FakeServer()
+		pool = SessionPool(server.connect, size=1)
+		try:
+			await use(pool, error=KeyError("pid"))
+		except KeyError:
+			pass
+		await use(pool)
+		return server
+	assert asyncio.run(main()).logins == 1
+
+def test_connection_errors_replace_the_session():
+	async def main():
+		server = FakeServer()
+		pool = SessionPool(server.connect, size=1)
+		try:
+			await use(pool, error=RuntimeError("RMC connection is closed"))
+		except RuntimeError:
+			pass
+		await use(pool)
+		return server, pool
+	server, pool = asyncio.run(main())
+	assert server.logins == 2
+	assert pool.metrics()["open"] == 1
+
+def test_failed_login_lets_a_waiting_request_retry():
+	async def main():
+		attempts = []
+		@contextlib.asynccontextmanager
+		async def connect():
+			attempts.append(None)
+			await asyncio.sleep(0.01)
+			if len(attempts) == 1:
+				raise ConnectionError("login failed")
+			yield object()
+		pool = SessionPool(connect, size=1, streams=2)
+		return await asyncio.wait_for(asyncio.gather(use(pool), use(pool), return_exceptions=True), 1)
+	results = asyncio.run(main())
+	# Whoever waited on the failed login opens a session of its own
+	assert not isinstance(results[1], BaseException)
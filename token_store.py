@@ -0,0 +1,36 @@
+import fcntl
+import json
+import os
+
+from cache_store import atomic_write
+
+class TokenStore:
+	# Tokens of one identity shared by every worker process through a file,
+	# the lock makes sure only one of them talks to Nintendo's servers at a time
+	def __init__(self, path):
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		self.path = path
+
+	def lock(self):
+		# Blocks until no other process holds the lock
+		fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX)
+		except:
+			os.close(fd)
+			raise
+		return fd
+
+	def unlock(self, fd):
+		fcntl.flock(fd, fcntl.LOCK_UN)
+		os.close(fd)
+
+	def load(self):
+		try:
+			with open(self.path) as f:
+				return json.load(f)
+		except (FileNotFoundError, ValueError):
+			return None
+
+	def save(self, state):
+		atomic_write(self.path, json.dumps(state).encode("utf-8"), private=True)